@@ -1,48 +1,206 @@
-import random as rd
+import bisect
+import itertools
+import os
 from multiprocessing import Pool
 
-import matplotlib.pyplot as plt
-import networkx as nx
 import numpy as np
 
+from gnn4bcprediction.topology_store import Topology
 
-def generate_random_uniform_values(n=1000, generator=rd.Random(0), min_val=0,
+
+def generate_random_uniform_values(n=1000, generator=None, min_val=0,
                                    max_val=1):
     """Create a random uniform distribution of opinions in the interval
-    [min_val, max_val]."""
+    [min_val, max_val] with a numpy Generator (seeded with 0 by default)."""
+
+    if generator is None:
+        generator = np.random.default_rng(0)
+    return generator.uniform(min_val, max_val, size=n)
+
 
-    opinion = []
-    for i in range(n):
-        opinion.append(generator.uniform(min_val, max_val))
-    return opinion
+def spawn_seeds(seed, n):
+    """Derive ``n`` independent seed sequences from a seed.
+
+    Unlike ``SeedSequence.spawn``, the seed is not modified, so the same
+    children are obtained every time.
+
+    Parameters
+    ----------
+    seed : int or np.random.SeedSequence
+        Parent seed.
+    n : int
+        Number of children.
+
+    Returns
+    -------
+    list[np.random.SeedSequence]
+        The children seed sequences.
+    """
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    return [np.random.SeedSequence(seed.entropy,
+                                   spawn_key=seed.spawn_key + (i,),
+                                   pool_size=seed.pool_size) for i in
+            range(n)]
 
 
 def check_seeding(seeding):
     """Check if all nodes are included in the seeding."""
 
     nodes = np.zeros(len(seeding), dtype=bool)
-    for s in seeding:
-        nodes[s] = True
-    all_nodes = True
-    for n in nodes:
-        if not n:
-            all_nodes = False
-            break
-    return all_nodes
+    nodes[np.asarray(seeding, dtype=np.int64)] = True
+    return bool(nodes.all())
+
+
+def graph_to_csr(graph):
+    """Build the CSR adjacency (indptr, indices) of a graph whose nodes are
+    labelled 0..n-1, keeping the neighbor order of ``graph.neighbors``."""
+    if isinstance(graph, Topology):
+        # Already stored as CSR arrays
+        return graph.indptr, graph.indices
+
+    num_nodes = graph.number_of_nodes()
+    degrees = [len(graph.adj[node]) for node in range(num_nodes)]
+
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(degrees, out=indptr[1:])
+    indices = np.fromiter(itertools.chain.from_iterable(
+        graph.adj[node] for node in range(num_nodes)), dtype=np.int64,
+        count=indptr[-1])
+
+    return indptr, indices
+
+
+class TrajectoryRecorder:
+    """Recorder of the intermediate opinions (time step, opinion) of a
+    simulation.
+
+    Points are stored in a preallocated buffer, keeping the opinions as
+    float32. When the buffer fills, it is spilled to a ``.npy`` file if a
+    path is given, or grown otherwise. A recorder is meant to be used for a
+    single simulation.
+
+    Parameters
+    ----------
+    stride : int
+        Only the time steps multiple of the stride are recorded.
+    buffer_size : int
+        Number of points kept in memory.
+    spill_path : str
+        ``.npy`` file where the points are spilled when the buffer fills.
+    """
+
+    dtype = np.dtype([('step', np.int64), ('opinion', np.float32)])
+
+    def __init__(self, stride=1, buffer_size=2 ** 20, spill_path=None):
+        self.stride = stride
+        self.spill_path = spill_path
+        self._buffer = np.empty(buffer_size, dtype=self.dtype)
+        self._count = 0
+        self._spilled = 0
+        self._file = None
+
+    def record(self, step, opinion):
+        """Record the opinion of an agent at a time step."""
+        if step % self.stride:
+            return
+        if self._count == len(self._buffer):
+            self._flush()
+        self._buffer[self._count] = (step, opinion)
+        self._count += 1
+
+    def record_many(self, steps, opinions):
+        """Record the opinions of several agents at their time steps."""
+        steps = np.asarray(steps)
+        opinions = np.asarray(opinions)
+        if self.stride > 1:
+            sampled = steps % self.stride == 0
+            steps = steps[sampled]
+            opinions = opinions[sampled]
+
+        start = 0
+        while start < len(steps):
+            if self._count == len(self._buffer):
+                self._flush()
+            end = start + min(len(steps) - start,
+                              len(self._buffer) - self._count)
+            chunk = self._buffer[self._count:self._count + end - start]
+            chunk['step'] = steps[start:end]
+            chunk['opinion'] = opinions[start:end]
+            self._count += end - start
+            start = end
+
+    def finish(self):
+        """Stop recording.
+
+        Returns
+        -------
+        list[np.ndarray]
+            2D points with intermediate opinions vs timestep, memory-mapped
+            from the spill file if the buffer was spilled.
+        """
+        if self._file is None:
+            points = self._buffer[:self._count]
+        else:
+            self._flush()
+            # Write the final shape in the header of the spill file
+            self._file.seek(0)
+            np.lib.format.write_array_header_1_0(
+                self._file, {'descr': np.lib.format.dtype_to_descr(self.dtype),
+                             'fortran_order': False,
+                             'shape': (self._spilled,)})
+            self._file.close()
+            self._file = None
+            points = np.load(self.spill_path, mmap_mode='r')
+
+        return [points['step'], points['opinion']]
+
+    def _flush(self):
+        """Spill the buffer to disk, or grow it if there is no spill path."""
+        if self.spill_path is None:
+            self._buffer = np.resize(self._buffer, 2 * len(self._buffer))
+            return
+
+        if self._file is None:
+            # The header is rewritten in place with the final shape
+            self._file = open(self.spill_path, 'wb')
+            np.lib.format.write_array_header_1_0(
+                self._file, {'descr': np.lib.format.dtype_to_descr(self.dtype),
+                             'fortran_order': False, 'shape': (0,)})
+        self._file.seek(0, os.SEEK_END)
+        self._file.write(self._buffer[:self._count].tobytes())
+        self._spilled += self._count
+        self._count = 0
 
 
-def dw_model(initial_op=generate_random_uniform_values(n=1000),
-             graph=nx.complete_graph(1000), seeding=None,
-             simulation_steps=100000, convergence=0.1,
-             threshold_bc=np.full(1000, 0.25), seed=0):
+def _default_arguments(initial_op, graph, threshold_bc):
+    """Fill the simulation arguments left as None with their defaults: 1000
+    random uniform opinions on a complete graph, with threshold 0.25."""
+    if initial_op is None:
+        initial_op = generate_random_uniform_values(n=1000)
+    if graph is None:
+        import networkx as nx
+        graph = nx.complete_graph(len(initial_op))
+    if threshold_bc is None:
+        threshold_bc = np.full(len(initial_op), 0.25)
+
+    return initial_op, graph, threshold_bc
+
+
+def dw_model(initial_op=None, graph=None, seeding=None,
+             simulation_steps=100000, convergence=0.1, threshold_bc=None,
+             seed=0, block_size=10000, tolerance=None, window=None,
+             recorder=None):
     """Simulate the Deffuant-Weisbuch model.
 
     Parameters
     ----------
     initial_op : list[float]
-        List with the initial opinion of each agent.
+        List with the initial opinion of each agent (1000 random uniform
+        opinions by default).
     graph : nx.Graph
-        Graph representing the social network between agents.
+        Graph representing the social network between agents (complete graph
+        by default).
     seeding : list[int]
         Distribution of agents in the graph nodes.
     simulation_steps : int
@@ -50,22 +208,37 @@ def dw_model(initial_op=generate_random_uniform_values(n=1000),
     convergence : float
         Convergence speed.
     threshold_bc : list[float]
-        List with the confidence threshold of each agent.
-    seed : int
+        List with the confidence threshold of each agent (0.25 by default).
+    seed : int or np.random.SeedSequence
         Random seed for reproducibility.
+    block_size : int
+        Number of steps whose random edges are drawn at once.
+    tolerance : float
+        If given, stop once the maximum opinion change over the last
+        ``window`` steps stays below this tolerance.
+    window : int
+        Number of steps of the stopping rule (10 times the number of agents
+        by default).
+    recorder : TrajectoryRecorder
+        Recorder of the intermediate opinions (every step by default).
 
     Returns
     -------
     tuple
         A tuple with the following elements:
 
-        list[list[int, float]]
+        list[np.ndarray]
             2D points with intermediate opinions vs timestep.
         list[float]
             List with the final opinion of each agent.
+        int
+            Number of simulated steps.
 
     """
-    if not seeding:
+    initial_op, graph, threshold_bc = _default_arguments(initial_op, graph,
+                                                         threshold_bc)
+
+    if seeding is None:
         seeding = range(len(initial_op))
 
     # Check that the number of nodes matches the number of opinions
@@ -88,75 +261,222 @@ def dw_model(initial_op=generate_random_uniform_values(n=1000),
         print("ERROR: theshold_bc don't match #agents!")
         exit
 
-    # Initialize the seed
-    rd.seed(seed)
+    # Initialize the random generator
+    generator = np.random.default_rng(seed)
 
     # Copy the initial opinions to an auxiliary list
     opinions = np.copy(initial_op)
+    threshold_bc = np.asarray(threshold_bc, dtype=float)
 
-    # List to save the intermediate opinions
-    data_plot = [[], []]
+    # Recorder of the intermediate opinions
+    if recorder is None:
+        recorder = TrajectoryRecorder(
+            buffer_size=max(2 * simulation_steps, 1))
 
-    # List of edges
-    edges = list(graph.edges())
+    # Endpoints of the edges, already mapped to their agents
+    # (each edge once, in the order of graph.edges())
+    seeding = np.asarray(seeding)
+    indptr, indices = graph_to_csr(graph)
+    sources = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    first = indices >= sources
+    agents1 = seeding[sources[first]].astype(np.int32)
+    agents2 = seeding[indices[first]].astype(np.int32)
 
-    # Iterate until a maximum number of iterations...
-    for i in range(simulation_steps):
+    # Step of the last opinion change above the tolerance
+    if window is None:
+        window = 10 * len(opinions)
+    last_change = -1
+    steps = simulation_steps
+
+    for block_start in range(0, simulation_steps, block_size):
+        block = min(block_size, simulation_steps - block_start)
 
-        # ... choose a random edge
-        random_edge = rd.choice(edges)
+        # Choose a random edge for every step of the block...
+        random_edges = generator.integers(0, len(agents1), size=block)
         # ... and its agents
-        ag1 = seeding[random_edge[0]]
-        ag2 = seeding[random_edge[1]]
+        block_ag1 = agents1[random_edges]
+        block_ag2 = agents2[random_edges]
+
+        block_opinions = np.copy(opinions) if tolerance is not None else None
+        after1, after2, changes = _dw_steps(opinions, block_ag1, block_ag2,
+                                            threshold_bc, convergence)
+
+        if tolerance is not None:
+            stop, last_change = _quiet_step(changes, block_start, last_change,
+                                            tolerance, window)
+            if stop is not None:
+                # Repeat the block from its start up to the stopping step
+                steps = block_start + stop + 1
+                opinions[:] = block_opinions
+                after1, after2, changes = _dw_steps(
+                    opinions, block_ag1[:stop + 1], block_ag2[:stop + 1],
+                    threshold_bc, convergence)
+
+        # Add the intermediate opinions to the recorder
+        recorder.record_many(
+            np.repeat(block_start + np.arange(len(after1)), 2),
+            np.stack([after1, after2], axis=1).ravel())
+
+        if steps < simulation_steps:
+            break
+
+    return recorder.finish(), opinions, steps
+
+
+def _dw_steps(opinions, agents1, agents2, threshold_bc, convergence):
+    """Apply a sequence of DW interactions to the opinions in place.
+
+    Returns
+    -------
+    tuple
+        The opinions of both agents after each step and the maximum opinion
+        change of each step.
+    """
+    after1 = np.empty(len(agents1))
+    after2 = np.empty(len(agents2))
+    changes = np.empty(len(agents1))
+
+    # Steps that share no agent can be applied at once with the same
+    # result as applying them one after the other
+    steps, bounds = _dependency_levels(agents1, agents2, len(opinions))
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        level_steps = steps[start:end]
+        ag1 = agents1[level_steps]
+        ag2 = agents2[level_steps]
         # ... get their opinions
         op1 = opinions[ag1]
         op2 = opinions[ag2]
 
         # BOUNDED CONFIDENCE
-        if abs(op1 - op2) < threshold_bc[ag1]:
-            opinions[ag1] += convergence * (op2 - op1)
-        if abs(op1 - op2) < threshold_bc[ag2]:
-            opinions[ag2] += convergence * (op1 - op2)
+        update1 = np.abs(op1 - op2) < threshold_bc[ag1]
+        update2 = np.abs(op1 - op2) < threshold_bc[ag2]
+        opinions[ag1[update1]] += convergence * (op2 - op1)[update1]
+        opinions[ag2[update2]] += convergence * (op1 - op2)[update2]
+
+        after1[level_steps] = opinions[ag1]
+        after2[level_steps] = opinions[ag2]
+        changes[level_steps] = np.maximum(np.abs(opinions[ag1] - op1),
+                                          np.abs(opinions[ag2] - op2))
+
+    return after1, after2, changes
+
+
+def _quiet_step(changes, offset, last_change, tolerance, window):
+    """Find the first step at which the opinion changes have stayed below
+    the tolerance for a whole window of steps.
+
+    Parameters
+    ----------
+    changes : np.ndarray
+        Maximum opinion change of each step of a block.
+    offset : int
+        Step at which the block starts.
+    last_change : int
+        Last step before the block with a change above the tolerance.
+    tolerance : float
+        Tolerance of the stopping rule.
+    window : int
+        Number of steps of the stopping rule.
+
+    Returns
+    -------
+    tuple
+        The position of the stopping step in the block (None if the run
+        does not stop within it) and the last step with a change above the
+        tolerance.
+    """
+    steps = offset + np.arange(len(changes))
+    last_changes = np.maximum.accumulate(
+        np.where(changes >= tolerance, steps, last_change))
+    quiet = np.flatnonzero(steps - last_changes >= window)
+
+    if quiet.size:
+        return quiet[0], last_changes[quiet[0]]
+    if len(changes):
+        last_change = last_changes[-1]
+    return None, last_change
+
+
+def _dependency_levels(agents1, agents2, num_agents):
+    """Group a sequence of pairwise interactions into levels of steps that
+    share no agent.
+
+    A step belongs to the level after the last one in which any of its
+    agents took part, so applying the levels in order gives the same result
+    as applying the steps one after the other.
 
-        # Add the intermediate opinion to the data_plot list
-        data_plot[0].append(i)
-        data_plot[1].append(opinions[ag1])
-        data_plot[0].append(i)
-        data_plot[1].append(opinions[ag2])
+    Returns
+    -------
+    tuple
+        The steps sorted by level and the boundaries of each level in that
+        order.
+    """
+    num_steps = len(agents1)
 
-    return data_plot, opinions
+    # Longest chain of previous steps sharing an agent with each step
+    last_level = [0] * num_agents
+    levels = []
+    for ag1, ag2 in zip(agents1.tolist(), agents2.tolist()):
+        level1 = last_level[ag1]
+        level2 = last_level[ag2]
+        level = (level1 if level1 > level2 else level2) + 1
+        last_level[ag1] = last_level[ag2] = level
+        levels.append(level)
+    levels = np.array(levels)
 
+    steps = np.argsort(levels, kind='stable')
+    bounds = np.flatnonzero(np.diff(levels[steps])) + 1
 
-def hk_model(initial_op=generate_random_uniform_values(n=1000),
-             graph=nx.complete_graph(1000), seeding=None,
-             simulation_steps=100000, threshold_bc=np.full(100, 0.25), seed=0):
+    return steps, np.concatenate(([0], bounds, [num_steps]))
+
+
+def hk_model(initial_op=None, graph=None, seeding=None,
+             simulation_steps=100000, threshold_bc=None, seed=0,
+             tolerance=None, window=None, block_size=10000, recorder=None):
     """Simulate the Hegselmann-Krause model.
 
     Parameters
     ----------
     initial_op : list[float]
-        List with the initial opinion of each agent.
+        List with the initial opinion of each agent (1000 random uniform
+        opinions by default).
     graph : nx.Graph
-        Graph representing the social network between agents.
+        Graph representing the social network between agents (complete graph
+        by default).
     seeding : list[int]
         Distribution of agents in the graph nodes.
     simulation_steps : int
         Number of simulation steps.
     threshold_bc : list[float]
-        List with the confidence threshold of each agent.
-    seed : int
+        List with the confidence threshold of each agent (0.25 by default).
+    seed : int or np.random.SeedSequence
         Random seed for reproducibility.
+    tolerance : float
+        If given, stop once the maximum opinion change over the last
+        ``window`` steps stays below this tolerance.
+    window : int
+        Number of steps of the stopping rule (10 times the number of agents
+        by default).
+    block_size : int
+        Number of steps whose random agents are drawn at once.
+    recorder : TrajectoryRecorder
+        Recorder of the intermediate opinions (every step by default).
 
     Returns
     -------
     tuple
         A tuple with the following elements:
 
-        list[list[int, float]]
+        list[np.ndarray]
             2D points with intermediate opinions vs timestep.
         list[float]
             List with the final opinion of each agent.
+        int
+            Number of simulated steps.
     """
+    initial_op, graph, threshold_bc = _default_arguments(initial_op, graph,
+                                                         threshold_bc)
+
     if not seeding:
         seeding = range(len(initial_op))
 
@@ -180,31 +500,43 @@ def hk_model(initial_op=generate_random_uniform_values(n=1000),
         print("ERROR: theshold_bc don't match #agents!")
         exit
 
-    # Initialize the seed
-    rd.seed(seed)
+    # List of neighbors of each agent
+    indptr, indices = graph_to_csr(graph)
+    neighbors = [indices[indptr[node]:indptr[node + 1]].tolist() for node in
+                 range(len(initial_op))]
+
+    if recorder is None:
+        recorder = TrajectoryRecorder(buffer_size=max(simulation_steps, 1))
+
+    return _hk_steps(initial_op, neighbors, seeding, simulation_steps,
+                     threshold_bc, seed, tolerance, window, block_size,
+                     recorder)
+
+
+def _hk_steps(initial_op, neighbors, seeding, simulation_steps, threshold_bc,
+              seed, tolerance, window, block_size=10000, recorder=None):
+    """Run the asynchronous HK updates of ``hk_model`` given the list of
+    neighbors of each node, recording the intermediate opinions only if a
+    recorder is given."""
+
+    # Initialize the random generator
+    generator = np.random.default_rng(seed)
 
     # Copy the initial opinions to an auxiliary list
     opinions = np.copy(initial_op)
 
-    # List to save the intermediate opinions
-    data_plot = [[], []]
-
     # Number of agents
     num_agents = len(opinions)
 
-    # List of neighbors of each agent
-    neighbors = []
-    for node in range(num_agents):
-        neighbors_of_node = []
-        for neigh in graph.neighbors(node):
-            neighbors_of_node.append(neigh)
-        neighbors.append(neighbors_of_node)
-
-    # Iterate until a maximum number of iterations...
-    for i in range(simulation_steps):
+    # Step of the last opinion change above the tolerance
+    if window is None:
+        window = 10 * num_agents
+    last_change = -1
+    steps = simulation_steps
 
-        # ... choose a random agent
-        node = rd.randint(0, num_agents - 1)
+    # Iterate until a maximum number of iterations choosing a random agent...
+    for i, node in enumerate(_random_agents(generator, num_agents,
+                                            simulation_steps, block_size)):
         ag = seeding[node]
         # ... get its opinion
         opinion = opinions[ag]
@@ -230,34 +562,600 @@ def hk_model(initial_op=generate_random_uniform_values(n=1000),
             neighbors_with_confidence += 1
             # Update the opinion of the agent
             opinions[ag] = sum_opinion_neighbors / neighbors_with_confidence
-            # Add the intermediate opinion to the data_plot list
-            data_plot[0].append(i)
-            data_plot[1].append(opinions[ag])
+            # Add the intermediate opinion to the recorder
+            if recorder is not None:
+                recorder.record(i, opinions[ag])
+
+            if tolerance is not None and \
+                    abs(opinions[ag] - opinion) >= tolerance:
+                last_change = i
+
+        # ... or until the opinions stop changing
+        if tolerance is not None and i - last_change >= window:
+            steps = i + 1
+            break
+
+    # Return the intermediate opinions, the final opinions and the number of
+    # simulated steps
+    data_plot = recorder.finish() if recorder is not None else [[], []]
+    return data_plot, opinions, steps
+
+
+def _random_agents(generator, num_agents, simulation_steps, block_size):
+    """Yield a random agent for every step, drawing them in blocks."""
+    for block_start in range(0, simulation_steps, block_size):
+        block = min(block_size, simulation_steps - block_start)
+        yield from generator.integers(0, num_agents, size=block).tolist()
+
+
+def hk_model_complete(initial_op, seeding=None, simulation_steps=100000,
+                      threshold_bc=0.25, seed=0, tolerance=None, window=None,
+                      block_size=10000, recorder=None):
+    """Simulate the Hegselmann-Krause model on a complete graph with a
+    homogeneous confidence threshold.
+
+    On a complete graph the agents within the confidence threshold of an
+    agent are the ones whose opinion lies in an interval around its own
+    opinion, so the opinions are kept sorted and every step costs a
+    logarithmic number of operations instead of one per neighbor. The
+    random agents are drawn as in ``hk_model`` on ``nx.complete_graph``, and
+    the opinions only differ from it in the rounding of the sums.
+
+    Parameters
+    ----------
+    initial_op : list[float]
+        List with the initial opinion of each agent.
+    seeding : list[int]
+        Distribution of agents in the graph nodes.
+    simulation_steps : int
+        Number of simulation steps.
+    threshold_bc : float or list[float]
+        Confidence threshold, shared by all the agents.
+    seed : int or np.random.SeedSequence
+        Random seed for reproducibility.
+    tolerance : float
+        If given, stop once the maximum opinion change over the last
+        ``window`` steps stays below this tolerance.
+    window : int
+        Number of steps of the stopping rule (10 times the number of agents
+        by default).
+    block_size : int
+        Number of steps whose random agents are drawn at once.
+    recorder : TrajectoryRecorder
+        Recorder of the intermediate opinions (every step by default).
+
+    Returns
+    -------
+    tuple
+        A tuple with the following elements:
+
+        list[np.ndarray]
+            2D points with intermediate opinions vs timestep.
+        list[float]
+            List with the final opinion of each agent.
+        int
+            Number of simulated steps.
+    """
+    if not seeding:
+        seeding = range(len(initial_op))
+
+    # Check that the number of opinions matches the size of the seeding
+    if not len(initial_op) == len(seeding):
+        print("ERROR: seeding don't match #agents!")
+        exit
+
+    # Check that all nodes/agents are included in the seeding
+    if not check_seeding(seeding):
+        print("ERROR: seeding is not complete!")
+        exit
+
+    # Check that all the agents share the same threshold
+    thresholds = np.unique(threshold_bc)
+    if not len(thresholds) == 1:
+        print("ERROR: threshold_bc is not homogeneous!")
+        exit
+    threshold = float(thresholds[0])
+
+    if recorder is None:
+        recorder = TrajectoryRecorder(buffer_size=max(simulation_steps, 1))
+
+    # Initialize the random generator
+    generator = np.random.default_rng(seed)
 
-    # Return the intermediate opinions and the final opinions
-    return data_plot, opinions
+    # Copy the initial opinions and index them by value
+    opinions = np.array(initial_op, dtype=float)
+    index = _OpinionIndex(opinions.tolist())
+    seeding = list(seeding)
 
+    # Number of agents
+    num_agents = len(opinions)
+
+    # Step of the last opinion change above the tolerance
+    if window is None:
+        window = 10 * num_agents
+    last_change = -1
+    steps = simulation_steps
+
+    for i, node in enumerate(_random_agents(generator, num_agents,
+                                            simulation_steps, block_size)):
+        ag = seeding[node]
+        opinion = opinions[ag]
+
+        # Opinions within the confidence threshold, the agent's included
+        count, total = index.query(opinion, threshold)
+
+        if count > 1:
+            new_opinion = total / count
+            opinions[ag] = new_opinion
+            index.replace(opinion, new_opinion)
+            recorder.record(i, new_opinion)
+
+            if tolerance is not None and \
+                    abs(new_opinion - opinion) >= tolerance:
+                last_change = i
+
+        if tolerance is not None and i - last_change >= window:
+            steps = i + 1
+            break
+
+    return recorder.finish(), opinions, steps
+
+
+class _OpinionIndex:
+    """Sorted multiset of opinions split in blocks, with Fenwick trees over
+    the count and the sum of each block, to get the number and the sum of
+    the opinions within a confidence threshold in logarithmic time."""
+
+    def __init__(self, opinions, block_size=128):
+        self._block_size = block_size
+        values = sorted(opinions)
+        self._blocks = [values[i:i + block_size] for i in
+                        range(0, len(values), block_size)]
+        self._rebuild(exact=True)
+
+    def _rebuild(self, exact=False):
+        """Recompute the block maxima and the Fenwick trees, and the sum of
+        each block if ``exact``."""
+        if exact:
+            self._totals = [sum(block) for block in self._blocks]
+            # Recompute the sums periodically so that their rounding does not
+            # accumulate
+            self._updates = 0
+        self._maxes = [block[-1] for block in self._blocks]
+        self._counts = [len(block) for block in self._blocks]
+        self._sums = list(self._totals)
+        for i in range(len(self._blocks)):
+            j = i | (i + 1)
+            if j < len(self._blocks):
+                self._counts[j] += self._counts[i]
+                self._sums[j] += self._sums[i]
+
+    def _add(self, block, count, total):
+        """Add a count and a sum to a block in the Fenwick trees."""
+        self._totals[block] += total
+        while block < len(self._blocks):
+            self._counts[block] += count
+            self._sums[block] += total
+            block |= block + 1
+
+    def _prefix(self, block, position):
+        """Count and sum of the opinions before a position of a block."""
+        count = position
+        if not position:
+            total = 0.
+        elif 2 * position <= len(self._blocks[block]):
+            total = sum(self._blocks[block][:position])
+        else:
+            total = self._totals[block] - sum(self._blocks[block][position:])
+        while block > 0:
+            count += self._counts[block - 1]
+            total += self._sums[block - 1]
+            block &= block - 1
+        return count, total
+
+    def _first(self, predicate, start):
+        """First block and position whose opinion satisfies a predicate that
+        is false up to some opinion and true after it, searching from an
+        approximate position of the boundary."""
+        blocks, maxes = self._blocks, self._maxes
+        block = bisect.bisect_left(maxes, start)
+        while block > 0 and predicate(maxes[block - 1]):
+            block -= 1
+        while block < len(blocks) and not predicate(maxes[block]):
+            block += 1
+        if block == len(blocks):
+            return block, 0
+
+        values = blocks[block]
+        position = bisect.bisect_left(values, start)
+        while position > 0 and predicate(values[position - 1]):
+            position -= 1
+        while not predicate(values[position]):
+            position += 1
+        return block, position
+
+    def query(self, opinion, threshold):
+        """Number and sum of the opinions ``v`` with
+        ``abs(v - opinion) < threshold``."""
+        # The comparison is made as in hk_model, which gives an interval of
+        # the sorted opinions whose ends can differ from opinion +- threshold
+        # in the last bit
+        low = self._first(lambda v: v >= opinion or opinion - v < threshold,
+                          opinion - threshold)
+        high = self._first(lambda v: v > opinion and v - opinion >= threshold,
+                           opinion + threshold)
+        count_low, total_low = self._prefix(*low)
+        count_high, total_high = self._prefix(*high)
+        return count_high - count_low, total_high - total_low
+
+    def replace(self, old, new):
+        """Replace an opinion by a new one."""
+        blocks = self._blocks
+
+        # Insert the new opinion, splitting its block if it grows too much
+        block = min(bisect.bisect_left(self._maxes, new), len(blocks) - 1)
+        values = blocks[block]
+        bisect.insort(values, new)
+        self._maxes[block] = values[-1]
+        self._add(block, 1, new)
+        if len(values) > 2 * self._block_size:
+            blocks[block:block + 1] = [values[:self._block_size],
+                                       values[self._block_size:]]
+            self._totals[block:block + 1] = [sum(blocks[block]),
+                                             sum(blocks[block + 1])]
+            self._rebuild()
+
+        # Remove the old opinion, dropping its block if it gets empty
+        block = bisect.bisect_left(self._maxes, old)
+        values = blocks[block]
+        del values[bisect.bisect_left(values, old)]
+        if values:
+            self._maxes[block] = values[-1]
+            self._add(block, -1, -old)
+        else:
+            del blocks[block]
+            del self._totals[block]
+            self._rebuild()
+
+        self._updates += 1
+        if self._updates >= len(blocks) * self._block_size:
+            self._rebuild(exact=True)
+
+
+def hk_model_sync(initial_op, graph, seeding=None, simulation_steps=1000,
+                  threshold_bc=None, tolerance=None, window=1, recorder=None):
+    """Simulate the synchronous (round-based) Hegselmann-Krause model.
+
+    In each round every agent updates its opinion at the same time, using
+    the opinions of the previous round. A round is computed with sparse
+    matrix products over the adjacency masked by
+    ``|x_i - x_j| < threshold_bc[i]``, so it touches all edges at once.
+
+    Parameters
+    ----------
+    initial_op : list[float]
+        List with the initial opinion of each agent.
+    graph : nx.Graph
+        Graph representing the social network between agents.
+    seeding : list[int]
+        Distribution of agents in the graph nodes.
+    simulation_steps : int
+        Number of simulation rounds.
+    threshold_bc : list[float]
+        List with the confidence threshold of each agent (0.25 by default).
+    tolerance : float
+        If given, stop once the maximum opinion change over the last
+        ``window`` rounds stays below this tolerance.
+    window : int
+        Number of rounds of the stopping rule.
+    recorder : TrajectoryRecorder
+        Recorder of the intermediate opinions (every round by default).
+
+    Returns
+    -------
+    tuple
+        A tuple with the following elements:
+
+        list[np.ndarray]
+            2D points with intermediate opinions vs round.
+        list[float]
+            List with the final opinion of each agent.
+        int
+            Number of simulated rounds.
+    """
+    import scipy.sparse as sp
+
+    num_agents = len(initial_op)
+
+    if threshold_bc is None:
+        threshold_bc = np.full(num_agents, 0.25)
+
+    if seeding is None:
+        seeding = np.arange(num_agents)
+    seeding = np.asarray(seeding)
+
+    # Check that the number of nodes matches the number of opinions
+    if not num_agents == graph.number_of_nodes():
+        print("ERROR: graph size don't match #agents!")
+        exit
+
+    # Check that the number of opinions matches the size of the seeding
+    if not num_agents == len(seeding):
+        print("ERROR: seeding don't match #agents!")
+        exit
+
+    # Check that all nodes/agents are included in the seeding
+    if not check_seeding(seeding):
+        print("ERROR: seeding is not complete!")
+        exit
+
+    # Check that the number of agents matches the number of thresholds
+    if not num_agents == len(threshold_bc):
+        print("ERROR: theshold_bc don't match #agents!")
+        exit
 
-def run_hk_model_mc(mc, initial_op=generate_random_uniform_values(n=1000),
-                    graph=nx.complete_graph(1000), seeding=None,
-                    simulation_steps=100000, threshold_bc=np.full(100, 0.25)):
-    final_opinions = []
-    data_plot = []
+    # Adjacency between agents, with one entry per edge endpoint
+    indptr, indices = graph_to_csr(graph)
+    adjacency = sp.csr_matrix(
+        (np.ones(len(indices)),
+         (seeding[np.repeat(np.arange(num_agents), np.diff(indptr))],
+          seeding[indices])), shape=(num_agents, num_agents))
+    adjacency.sum_duplicates()
+    rows = np.repeat(np.arange(num_agents), np.diff(adjacency.indptr))
+    cols = adjacency.indices
+    multiplicity = adjacency.data
 
-    args = [(initial_op, graph, seeding, simulation_steps, threshold_bc, i) for
-            i in range(mc)]
+    threshold_bc = np.asarray(threshold_bc, dtype=float)
+    opinions = np.array(initial_op, dtype=float)
 
-    with Pool() as pool:
-        for result in pool.starmap(hk_model, args):
-            data_plot.append(result[0])
-            final_opinions.append(result[1])
+    # Recorder of the intermediate opinions
+    if recorder is None:
+        recorder = TrajectoryRecorder()
 
-    return data_plot, final_opinions
+    # Round of the last opinion change above the tolerance
+    last_change = -1
+    steps = simulation_steps
+
+    for i in range(simulation_steps):
+        # BOUNDED CONFIDENCE: mask the edges within the threshold of the
+        # updating agent
+        with_confidence = sp.csr_matrix(
+            (multiplicity * (np.abs(opinions[cols] - opinions[rows]) <
+                             threshold_bc[rows]), cols, adjacency.indptr),
+            shape=adjacency.shape)
+        neighbors_with_confidence = with_confidence @ np.ones(num_agents)
+        sum_opinion_neighbors = with_confidence @ opinions
+
+        # Consider the opinion of the agent itself when it has at least one
+        # neighbor within the threshold
+        updated = neighbors_with_confidence > 0
+        new_opinions = opinions.copy()
+        new_opinions[updated] = \
+            (sum_opinion_neighbors[updated] + opinions[updated]) / \
+            (neighbors_with_confidence[updated] + 1)
+
+        # Add the changed opinions to the recorder
+        changed = np.flatnonzero(new_opinions != opinions)
+        recorder.record_many(np.full(len(changed), i), new_opinions[changed])
+
+        if tolerance is not None and \
+                np.max(np.abs(new_opinions - opinions)) >= tolerance:
+            last_change = i
+
+        opinions = new_opinions
+
+        # ... or until the opinions stop changing
+        if tolerance is not None and i - last_change >= window:
+            steps = i + 1
+            break
+
+    return recorder.finish(), opinions, steps
+
+
+def run_hk_model_mc(mc, initial_op=None, graph=None, seeding=None,
+                    simulation_steps=100000, threshold_bc=None, tolerance=None,
+                    window=None, pool=None, seed=0, cache=None):
+    initial_op, graph, threshold_bc = _default_arguments(initial_op, graph,
+                                                         threshold_bc)
+
+    if cache is not None:
+        # Final opinions of a previous run with the same inputs
+        key = cache.key('hk', graph, initial_op, threshold_bc,
+                        simulation_steps, seed, mc=mc, seeding=seeding,
+                        tolerance=tolerance, window=window)
+        cached = cache.get(key)
+        if cached is not None:
+            return [[] for _ in range(mc)], cached[0], cached[1]
+
+    if pool is not None:
+        # Long-lived workers that already share the topology
+        final_opinions, steps = pool.run_hk_model_mc(
+            mc=mc, initial_op=initial_op, graph=graph, seeding=seeding,
+            simulation_steps=simulation_steps, threshold_bc=threshold_bc,
+            tolerance=tolerance, window=window, seed=seed)
+        data_plot = [[] for _ in range(mc)]
+    else:
+        final_opinions = []
+        data_plot = []
+        steps = []
+
+        # Independent random stream for each replica
+        args = [(initial_op, graph, seeding, simulation_steps, threshold_bc,
+                 replica_seed, tolerance, window) for replica_seed in
+                spawn_seeds(seed, mc)]
+
+        with Pool() as pool:
+            for result in pool.starmap(hk_model, args):
+                data_plot.append(result[0])
+                final_opinions.append(result[1])
+                steps.append(result[2])
+
+    if cache is not None:
+        cache.put(key, final_opinions, steps)
+
+    return data_plot, final_opinions, steps
+
+
+def run_hk_model_ensemble(mc, initial_op, graph, threshold_bc, seeding=None,
+                          simulation_steps=100000, block_size=10000,
+                          tolerance=None, window=None, seed=0):
+    """Simulate the Hegselmann-Krause model for every Monte Carlo replica and
+    threshold configuration at once.
+
+    Opinions are kept as a (replicas x configs x agents) array and each step
+    updates one random agent per replica and config with vectorized gathers
+    over the CSR adjacency of the graph. Each replica of each config draws
+    its agents from the same random stream as in ``run_hk_model_mc``, so the
+    final opinions match those of running it config by config.
+
+    Parameters
+    ----------
+    mc : int
+        Number of Monte Carlo replicas.
+    initial_op : list[float]
+        List with the initial opinion of each agent.
+    graph : nx.Graph
+        Graph representing the social network between agents.
+    threshold_bc : array-like
+        Confidence thresholds with shape (configs, agents), or a single list
+        of thresholds (one config).
+    seeding : list[int]
+        Distribution of agents in the graph nodes.
+    simulation_steps : int
+        Number of simulation steps.
+    block_size : int
+        Number of steps whose random agents are drawn at once.
+    tolerance : float
+        If given, each replica and config stops once its maximum opinion
+        change over the last ``window`` steps stays below this tolerance.
+    window : int
+        Number of steps of the stopping rule (10 times the number of agents
+        by default).
+    seed : int, np.random.SeedSequence or list
+        Random seed passed to ``run_hk_model_mc`` for every config, or a
+        list with the seed of each config.
+
+    Returns
+    -------
+    tuple
+        A tuple with the following elements:
+
+        np.ndarray
+            Final opinions with shape (replicas, configs, agents).
+        np.ndarray
+            Number of simulated steps with shape (replicas, configs).
+    """
+    num_agents = len(initial_op)
+    threshold_bc = np.atleast_2d(np.asarray(threshold_bc, dtype=float))
+    num_configs = threshold_bc.shape[0]
+
+    if seeding is None:
+        seeding = np.arange(num_agents)
+    seeding = np.asarray(seeding)
+
+    # Check that the number of nodes matches the number of opinions
+    if not num_agents == graph.number_of_nodes():
+        print("ERROR: graph size don't match #agents!")
+        exit
+
+    # Check that all nodes/agents are included in the seeding
+    if not check_seeding(seeding):
+        print("ERROR: seeding is not complete!")
+        exit
+
+    # Check that the number of agents matches the number of thresholds
+    if not num_agents == threshold_bc.shape[1]:
+        print("ERROR: theshold_bc don't match #agents!")
+        exit
+
+    # CSR adjacency with the neighbors already mapped to their agents
+    indptr, indices = graph_to_csr(graph)
+    neighbor_agents = seeding[indices]
+
+    # One row per (replica, config) pair
+    num_rows = mc * num_configs
+    rows = np.arange(num_rows)
+    row_config = rows % num_configs
+    opinions = np.tile(np.asarray(initial_op, dtype=float), (num_rows, 1))
+
+    # Rows still being simulated and step of their last opinion change above
+    # the tolerance
+    if window is None:
+        window = 10 * num_agents
+    live = rows
+    last_change = np.full(num_rows, -1)
+    steps = np.full(num_rows, simulation_steps)
+
+    # Independent random stream for each replica of each config
+    if not isinstance(seed, (list, tuple)):
+        seed = [seed] * num_configs
+    replica_seeds = [spawn_seeds(config_seed, mc) for config_seed in seed]
+    generators = [np.random.default_rng(replica_seeds[row % num_configs]
+                                        [row // num_configs]) for row in rows]
+
+    for block_start in range(0, simulation_steps, block_size):
+        block = min(block_size, simulation_steps - block_start)
+
+        # Random agent of each replica and config for every step of the block
+        draws = np.stack([generator.integers(0, num_agents, size=block) for
+                          generator in generators])
+
+        for step in range(block):
+            nodes = draws[live, step]
+            agents = seeding[nodes]
+            opinion = opinions[live, agents]
+            threshold = threshold_bc[row_config[live], agents]
+
+            # Gather the neighbors of the chosen node of every row
+            starts = indptr[nodes]
+            degrees = indptr[nodes + 1] - starts
+            ends = np.cumsum(degrees)
+            edge_rows = np.repeat(rows[:len(live)], degrees)
+            positions = np.arange(ends[-1]) + np.repeat(starts - ends + degrees,
+                                                        degrees)
+            op_neighbors = opinions[live[edge_rows],
+                                    neighbor_agents[positions]]
+
+            # BOUNDED CONFIDENCE
+            with_confidence = np.abs(op_neighbors - opinion[edge_rows]) < \
+                threshold[edge_rows]
+            neighbors_with_confidence = np.bincount(
+                edge_rows, weights=with_confidence, minlength=len(live))
+            sum_opinion_neighbors = np.bincount(
+                edge_rows, weights=op_neighbors * with_confidence,
+                minlength=len(live))
+
+            # Update the rows with at least one neighbor within the threshold,
+            # considering the opinion of the agent itself
+            updated = neighbors_with_confidence > 0
+            new_opinion = (sum_opinion_neighbors[updated] + opinion[updated]) \
+                / (neighbors_with_confidence[updated] + 1)
+            opinions[live[updated], agents[updated]] = new_opinion
+
+            # Stop the rows whose opinions stopped changing
+            if tolerance is not None:
+                i = block_start + step
+                changed = np.abs(new_opinion - opinion[updated]) >= tolerance
+                last_change[live[updated][changed]] = i
+                quiet = i - last_change[live] >= window
+                if quiet.any():
+                    steps[live[quiet]] = i + 1
+                    live = live[~quiet]
+                    if not live.size:
+                        break
+
+        if not live.size:
+            break
+
+    return opinions.reshape(mc, num_configs, num_agents), \
+        steps.reshape(mc, num_configs)
 
 
 def plot_opinions(initial_op, intermediate_op, final_op, title, filename="",
                   simulation_steps=100000, alpha=0.1):
     """Plot the opinion dynamics of the agents."""
+    import matplotlib.pyplot as plt
+
     fig, ax = plt.subplots(1, 2, figsize=(6, 3),
                            gridspec_kw={'width_ratios': [4, 1]})
     fig.tight_layout()
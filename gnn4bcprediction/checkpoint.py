@@ -0,0 +1,92 @@
+import copy
+import os
+import threading
+
+import torch
+
+
+def snapshot_state(state, buffer=None):
+    """Copy a (nested) state dict, reusing the tensors of a previous snapshot
+    with the same structure instead of allocating new ones.
+
+    Parameters
+    ----------
+    state : dict
+        State to copy, e.g. ``model.state_dict()``.
+    buffer : dict
+        Previous snapshot, updated in place where possible.
+
+    Returns
+    -------
+    dict
+        Snapshot of the state.
+    """
+    if torch.is_tensor(state):
+        if torch.is_tensor(buffer) and buffer.shape == state.shape and \
+                buffer.dtype == state.dtype and buffer.device == state.device:
+            return buffer.copy_(state)
+        return state.detach().clone()
+    if isinstance(state, dict):
+        return {key: snapshot_state(value, buffer.get(key) if
+                                    isinstance(buffer, dict) else None)
+                for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        buffers = buffer if isinstance(buffer, (list, tuple)) and \
+            len(buffer) == len(state) else [None] * len(state)
+        return type(state)(snapshot_state(value, value_buffer) for
+                           value, value_buffer in zip(state, buffers))
+    return copy.deepcopy(state)
+
+
+class Checkpointer:
+    """Periodic checkpoints of a training run, written to disk by a
+    background thread.
+
+    Each checkpoint is copied to a preallocated in-memory snapshot, which a
+    thread saves while training goes on. A new checkpoint waits for the
+    previous one to be written before reusing the snapshot, and files are
+    replaced atomically, so the file on disk is always a complete
+    checkpoint.
+
+    Parameters
+    ----------
+    path : str
+        File of the checkpoint.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._snapshot = None
+        self._thread = None
+
+    def load(self):
+        """Load the last checkpoint written, or None if there is none."""
+        if not os.path.exists(self.path):
+            return None
+        return torch.load(self.path, map_location='cpu', weights_only=False)
+
+    def save(self, state):
+        """Snapshot a checkpoint and write it in the background."""
+        self.wait()
+        self._snapshot = snapshot_state(state, self._snapshot)
+        self._thread = threading.Thread(target=self._write,
+                                        args=(self._snapshot,))
+        self._thread.start()
+
+    def wait(self):
+        """Wait for the checkpoint being written, if any."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def remove(self):
+        """Remove the checkpoint, e.g. once training has finished."""
+        self.wait()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _write(self, state):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        temp_file = f'{self.path}.{os.getpid()}.tmp'
+        torch.save(state, temp_file)
+        os.replace(temp_file, self.path)
@@ -1,51 +1,123 @@
 import copy
 import json
 import os
-import random
 import time
+from contextlib import nullcontext
 
 import networkx as nx
 import numpy as np
-import torch
-from sklearn.model_selection import train_test_split
-from torch_geometric.transforms import RandomNodeSplit
-from torch_geometric.utils import from_networkx
 
 from gnn4bcprediction.bc_models import generate_random_uniform_values, \
-    run_hk_model_mc
+    run_hk_model_mc, run_hk_model_ensemble, hk_model_sync, spawn_seeds
+from gnn4bcprediction.simulation_pool import SimulationPool
+from gnn4bcprediction.topology_store import Topology, from_networkx, \
+    node_attribute, save_topology
 
 
 def generate_threshold_per_community(graph, max_threshold, generator):
-    # Get the number of communities
-    num_communities = len(
-        set(nx.get_node_attributes(graph, 'community').values()))
+    # Get the community of each node
+    communities = np.asarray(node_attribute(graph, 'community'))
+
+    return generate_community_thresholds(communities, max_threshold,
+                                         generator)
+
+
+def generate_community_thresholds(communities, max_threshold, generator,
+                                  num_communities=None):
+    """Draw a random threshold for each community and give every node the
+    threshold of its community, with the same draws as
+    generate_threshold_per_community.
+
+    Parameters
+    ----------
+    communities : np.ndarray
+        Community label (0..k-1) of each node.
+    max_threshold : float
+        Maximum threshold.
+    generator : np.random.Generator
+        Generator of the thresholds.
+    num_communities : int
+        Number of communities, computed from the labels if not given.
+
+    Returns
+    -------
+    np.ndarray
+        Threshold of each node.
+    """
+    if num_communities is None:
+        num_communities = len(np.unique(communities))
 
     # Generate a random threshold for each community
     thresholds = generate_random_uniform_values(num_communities,
                                                 generator=generator,
                                                 max_val=max_threshold)
 
-    # Create a list of thresholds, where each node has the threshold of
-    # its community
-    threshold_bc = [thresholds[graph.nodes[node]['community']] for node in
-                    graph.nodes()]
-
-    return threshold_bc
+    return thresholds[communities]
 
 
 def generate_attribute_graph(base_graph, initial_opinions, threshold_bc,
-                             simulation_steps, mc, save_path=None):
-    G = copy.deepcopy(base_graph)
-    G.graph['mc'] = mc
-    G.graph['simulation_steps'] = simulation_steps
+                             simulation_steps, mc, save_path=None,
+                             mode='async', tolerance=None, window=None,
+                             pool=None, seed=0, cache=None):
+    mean_final_opinions = simulate_attribute_config(
+        base_graph, initial_opinions, threshold_bc, simulation_steps, mc,
+        mode=mode, tolerance=tolerance, window=window, pool=pool, seed=seed,
+        cache=cache)
+
+    return build_attribute_graph(base_graph, initial_opinions,
+                                 mean_final_opinions, threshold_bc,
+                                 simulation_steps, mc, save_path)
+
+
+def simulate_attribute_config(base_graph, initial_opinions, threshold_bc,
+                              simulation_steps, mc, mode='async',
+                              tolerance=None, window=None, pool=None, seed=0,
+                              cache=None):
+    if mode == 'sync':
+        # The synchronous model is deterministic: every replica would reach
+        # the same final opinions. simulation_steps counts single-agent
+        # asynchronous updates, while a round updates every agent
+        simulation_rounds = max(1, simulation_steps //
+                                base_graph.number_of_nodes())
+        cached = None
+        if cache is not None:
+            key = cache.key('hk_sync', base_graph, initial_opinions,
+                            threshold_bc, simulation_rounds, 0,
+                            tolerance=tolerance, window=window or 1)
+            cached = cache.get(key)
+
+        if cached is not None:
+            mean_final_opinions, steps = cached[0][0], cached[1][0]
+        else:
+            data_plot, mean_final_opinions, steps = hk_model_sync(
+                initial_op=initial_opinions, graph=base_graph,
+                threshold_bc=threshold_bc, simulation_steps=simulation_rounds,
+                tolerance=tolerance, window=window or 1)
+            if cache is not None:
+                cache.put(key, [mean_final_opinions], [steps])
+    else:
+        data_plot, final_opinions, steps = run_hk_model_mc(
+            mc=mc, initial_op=initial_opinions, graph=base_graph,
+            threshold_bc=threshold_bc, simulation_steps=simulation_steps,
+            tolerance=tolerance, window=window, pool=pool, seed=seed,
+            cache=cache)
+
+        mean_final_opinions = np.mean(np.array(final_opinions), axis=0)
 
-    data_plot, final_opinions = run_hk_model_mc(mc=mc,
-                                                initial_op=initial_opinions,
-                                                graph=G,
-                                                threshold_bc=threshold_bc,
-                                                simulation_steps=simulation_steps)
+    if tolerance is not None:
+        print('Stopped at step {}'.format(np.max(steps)))
 
-    mean_final_opinions = np.mean(np.array(final_opinions), axis=0)
+    return mean_final_opinions
+
+
+def build_attribute_graph(base_graph, initial_opinions, mean_final_opinions,
+                          threshold_bc, simulation_steps, mc, save_path=None):
+    if isinstance(base_graph, Topology):
+        G = base_graph.to_networkx()
+    else:
+        G = copy.deepcopy(base_graph)
+    G.graph['mc'] = mc
+    G.graph['simulation_steps'] = simulation_steps
 
     for i, nodo in enumerate(G.nodes()):
         G.nodes[nodo]['initial_opinion'] = initial_opinions[i]
@@ -60,45 +132,307 @@ def generate_attribute_graph(base_graph, initial_opinions, threshold_bc,
     return G
 
 
-def generate_multiple_attribute_graph(base_graph, initial_opinions,
-                                      simulation_steps, mc, num_graphs,
-                                      max_threshold, communities=False,
-                                      generator=None, save_path=None):
+def generate_threshold_configs(base_graph, num_graphs, max_threshold,
+                               communities=False, seed=0):
     n = base_graph.number_of_nodes()
 
-    if not communities:
+    if communities:
+        # The labels are gathered once for all the configs
+        labels = np.asarray(node_attribute(base_graph, 'community'))
+        num_communities = len(np.unique(labels))
+    else:
         thresholds = np.linspace(0.1, max_threshold, num_graphs)
-    G_list = []
+    threshold_list = []
+    simulation_seeds = []
 
-    for i in range(num_graphs):
-        print('Generating graph {}'.format(i))
+    for i, config_seed in enumerate(spawn_seeds(seed, num_graphs)):
+        # Independent random streams for the thresholds and the simulations
+        # of each config
+        threshold_seed, simulation_seed = spawn_seeds(config_seed, 2)
         if communities:
-            threshold_bc = generate_threshold_per_community(base_graph,
-                                                            max_threshold,
-                                                            generator)
+            threshold_bc = generate_community_thresholds(
+                labels, max_threshold, np.random.default_rng(threshold_seed),
+                num_communities)
         else:
             threshold_bc = np.ones(n) * thresholds[i]
+        threshold_list.append(threshold_bc)
+        simulation_seeds.append(simulation_seed)
 
-        G = generate_attribute_graph(base_graph=base_graph,
-                                     initial_opinions=initial_opinions,
-                                     threshold_bc=threshold_bc,
-                                     simulation_steps=simulation_steps, mc=mc)
-        G_list.append(G)
+    return threshold_list, simulation_seeds
 
+
+def generate_multiple_attribute_graph(base_graph, initial_opinions,
+                                      simulation_steps, mc, num_graphs,
+                                      max_threshold, communities=False,
+                                      seed=0, save_path=None,
+                                      ensemble=False, mode='async',
+                                      tolerance=None, window=None, pool=None,
+                                      cache=None):
+    threshold_list, mean_final_opinions = simulate_multiple_configs(
+        base_graph, initial_opinions, simulation_steps, mc, num_graphs,
+        max_threshold, communities=communities, seed=seed, ensemble=ensemble,
+        mode=mode, tolerance=tolerance, window=window, pool=pool, cache=cache)
+
+    return build_multiple_attribute_graph(base_graph, initial_opinions,
+                                          threshold_list, mean_final_opinions,
+                                          simulation_steps, mc, save_path)
+
+
+def simulate_multiple_configs(base_graph, initial_opinions, simulation_steps,
+                              mc, num_graphs, max_threshold, communities=False,
+                              seed=0, ensemble=False, mode='async',
+                              tolerance=None, window=None, pool=None,
+                              cache=None, callback=None):
+    threshold_list, simulation_seeds = generate_threshold_configs(
+        base_graph, num_graphs, max_threshold, communities, seed)
+    mean_final_opinions = []
+
+    if ensemble and mode == 'async':
+        # Simulate every replica of every threshold config in lockstep
+        print('Generating {} graphs'.format(num_graphs))
+        final_opinions = np.empty((mc, num_graphs,
+                                   base_graph.number_of_nodes()))
+        steps = np.empty((mc, num_graphs), dtype=int)
+
+        # Configs already simulated in a previous run
+        keys = [None] * num_graphs
+        missing = list(range(num_graphs))
+        if cache is not None:
+            keys = [cache.key('hk', base_graph, initial_opinions,
+                              threshold_bc, simulation_steps,
+                              simulation_seeds[i], mc=mc, tolerance=tolerance,
+                              window=window)
+                    for i, threshold_bc in enumerate(threshold_list)]
+            missing = []
+            for i, key in enumerate(keys):
+                cached = cache.get(key)
+                if cached is None:
+                    missing.append(i)
+                else:
+                    final_opinions[:, i], steps[:, i] = cached
+
+        if missing:
+            final_opinions[:, missing], steps[:, missing] = \
+                run_hk_model_ensemble(
+                    mc=mc, initial_op=initial_opinions, graph=base_graph,
+                    threshold_bc=[threshold_list[i] for i in missing],
+                    simulation_steps=simulation_steps, tolerance=tolerance,
+                    window=window,
+                    seed=[simulation_seeds[i] for i in missing])
+            if cache is not None:
+                for i in missing:
+                    cache.put(keys[i], final_opinions[:, i], steps[:, i])
+
+        mean_final_opinions = list(np.mean(final_opinions, axis=0))
+
+        if tolerance is not None:
+            print('Stopped at steps {}'.format(np.max(steps, axis=0)))
+
+        if callback is not None:
+            for i, threshold_bc in enumerate(threshold_list):
+                callback(i, threshold_bc, mean_final_opinions[i])
+                mean_final_opinions[i] = None
+    else:
+        for i, threshold_bc in enumerate(threshold_list):
+            print('Generating graph {}'.format(i))
+            mean_final_opinions.append(simulate_attribute_config(
+                base_graph=base_graph, initial_opinions=initial_opinions,
+                threshold_bc=threshold_bc, simulation_steps=simulation_steps,
+                mc=mc, mode=mode, tolerance=tolerance, window=window,
+                pool=pool, seed=simulation_seeds[i], cache=cache))
+
+            # Consume each config as soon as it finishes
+            if callback is not None:
+                callback(i, threshold_bc, mean_final_opinions[i])
+                mean_final_opinions[i] = None
+
+        if pool is not None:
+            pool.remove_topology(base_graph, initial_opinions)
+
+    return threshold_list, mean_final_opinions
+
+
+def build_multiple_attribute_graph(base_graph, initial_opinions,
+                                   threshold_list, mean_final_opinions,
+                                   simulation_steps, mc, save_path=None):
+    G_list = [build_attribute_graph(base_graph, initial_opinions,
+                                    mean_final_opinions[i], threshold_bc,
+                                    simulation_steps, mc)
+              for i, threshold_bc in enumerate(threshold_list)]
+
+    return join_attribute_graphs(G_list, save_path)
+
+
+def generate_sweep_attribute_graphs(topologies, initial_opinions,
+                                    simulation_steps, mc, num_graphs,
+                                    max_threshold, pool, communities=False,
+                                    seeds=None, save_paths=None,
+                                    tolerance=None, window=None, cache=None):
+    results = simulate_sweep_configs(
+        topologies, initial_opinions, simulation_steps, mc, num_graphs,
+        max_threshold, pool, communities=communities, seeds=seeds,
+        tolerance=tolerance, window=window, cache=cache)
+
+    return [build_multiple_attribute_graph(
+        topology, initial_opinions[i], results[i][0], results[i][1],
+        simulation_steps, mc,
+        save_paths[i] if save_paths is not None else None)
+        for i, topology in enumerate(topologies)]
+
+
+def simulate_sweep_configs(topologies, initial_opinions, simulation_steps, mc,
+                           num_graphs, max_threshold, pool, communities=False,
+                           seeds=None, tolerance=None, window=None,
+                           cache=None, callback=None):
+    if seeds is None:
+        seeds = [0] * len(topologies)
+
+    # Threshold configs of every topology, as in
+    # generate_multiple_attribute_graph
+    configs = [generate_threshold_configs(topology, num_graphs, max_threshold,
+                                          communities, seeds[i])
+               for i, topology in enumerate(topologies)]
+
+    mean_final_opinions = [[None] * num_graphs for _ in topologies]
+    keys = [[None] * num_graphs for _ in topologies]
+
+    def finish(i, c, result):
+        final_opinions, steps = result
+        if tolerance is not None:
+            print('Stopped at step {}'.format(np.max(steps)))
+
+        # Configs passed to the callback are not kept, so that they can be
+        # consumed as they finish
+        mean = np.mean(np.array(final_opinions), axis=0)
+        if callback is not None:
+            callback(i, c, configs[i][0][c], mean)
+        else:
+            mean_final_opinions[i][c] = mean
+
+    # Configs already simulated in a previous run
+    missing = [list(range(num_graphs)) for _ in topologies]
+    if cache is not None:
+        for i, topology in enumerate(topologies):
+            missing[i] = []
+            for c, (threshold_bc, seed) in enumerate(zip(*configs[i])):
+                keys[i][c] = cache.key('hk', topology, initial_opinions[i],
+                                       threshold_bc, simulation_steps, seed,
+                                       mc=mc, tolerance=tolerance,
+                                       window=window)
+                cached = cache.get(keys[i][c])
+                if cached is None:
+                    missing[i].append(c)
+                else:
+                    finish(i, c, cached)
+
+    def store(i, c, result):
+        # Cache every config as soon as it finishes, so that an interrupted
+        # sweep can be resumed
+        if cache is not None:
+            cache.put(keys[i][c], *result)
+        finish(i, c, result)
+
+    # Simulate every replica of every config of every topology as one queue
+    print('Generating {} graphs'.format(sum(map(len, missing))))
+    pool.run_hk_model_sweep(
+        [(topology, initial_opinions[i],
+          [configs[i][0][c] for c in missing[i]],
+          [configs[i][1][c] for c in missing[i]])
+         for i, topology in enumerate(topologies)], mc=mc,
+        simulation_steps=simulation_steps, tolerance=tolerance, window=window,
+        callback=lambda i, c, result: store(i, missing[i][c], result))
+
+    return [(configs[i][0], mean_final_opinions[i])
+            for i in range(len(topologies))]
+
+
+def join_attribute_graphs(G_list, save_path=None):
     # Combine all graphs as separate components
     G_complete = nx.disjoint_union_all(G_list)
 
-    if save_path is not None:
+    if save_path is not None and save_path.endswith('.json'):
         os.makedirs(os.path.dirname(save_path), exist_ok=True)
         with open(save_path, 'w') as f:
             json.dump(nx.node_link_data(G_complete), f)
+    elif save_path is not None:
+        # Topology store directory
+        save_topology(G_complete, save_path)
 
     return G_complete
 
 
+def build_topology_data(graph):
+    """Split a topology in connected components, with the PyG edge index and
+    the node and graph attributes of each one, to build the data of all its
+    threshold configs without going through networkx."""
+    import torch
+
+    topology = graph if isinstance(graph, Topology) else from_networkx(graph)
+
+    topology_data = []
+    for nodes, component in topology.components():
+        sources = np.repeat(np.arange(component.number_of_nodes()),
+                            np.diff(component.indptr))
+        component_data = {'nodes': torch.as_tensor(nodes),
+                          'edge_index': torch.as_tensor(np.stack(
+                              [sources, component.indices]))}
+        # Node attributes, as from_networkx loads them
+        for key, values in component.node_attributes.items():
+            if key not in ['initial_opinion', 'final_opinion', 'threshold']:
+                component_data[key] = _as_tensor(values.tolist())
+        for key, value in component.graph.items():
+            component_data[key] = _as_tensor(value)
+        topology_data.append(component_data)
+
+    return topology_data
+
+
+def build_attribute_data(topology_data, initial_opinions,
+                         mean_final_opinions, threshold_bc, simulation_steps,
+                         mc):
+    """Build the PyG data of each connected component of a topology from the
+    opinions and thresholds of a config, with the same attributes as
+    converting the graph of build_attribute_graph with from_networkx."""
+    import torch
+    from torch_geometric.data import Data
+
+    x = torch.as_tensor(np.stack([np.asarray(initial_opinions, dtype=float),
+                                  np.asarray(mean_final_opinions,
+                                             dtype=float)],
+                                 axis=1)).to(torch.float32)
+    y = torch.as_tensor(np.asarray(threshold_bc, dtype=float)).to(
+        torch.float32)
+
+    data_list = []
+    for component in topology_data:
+        nodes = component['nodes']
+        data = Data(**{key: value for key, value in component.items() if
+                       key != 'nodes'})
+        data.mc = torch.as_tensor(mc)
+        data.simulation_steps = torch.as_tensor(simulation_steps)
+        data.x = x[nodes]
+        data.y = y[nodes]
+        data_list.append(data)
+
+    return data_list
+
+
+def _as_tensor(value):
+    """Convert an attribute to a tensor if possible, as from_networkx."""
+    import torch
+
+    try:
+        return torch.as_tensor(value)
+    except Exception:
+        return value
+
+
 def create_pygdataset(graphs, per_val, per_test, seed, save_path):
+    # Only the datasets need the torch backends, not the simulations
+    import torch
+    from torch_geometric.utils import from_networkx
+
     torch.set_default_tensor_type(torch.FloatTensor)
-    torch.manual_seed(seed)
 
     # Separate connected components
     subgraphs = [graph.subgraph(c).copy() for graph in graphs for c in
@@ -113,10 +447,25 @@ def create_pygdataset(graphs, per_val, per_test, seed, save_path):
         data.x = data.x.to(torch.float32)
         data.y = data.y.to(torch.float32)
         del data.threshold
-        if per_val > 0 or per_test > 0:
-            data = RandomNodeSplit(num_val=per_val, num_test=per_test)(data)
         full_data.append(data)
 
+    return save_pygdataset(full_data, per_val, per_test, seed, save_path)
+
+
+def save_pygdataset(full_data, per_val, per_test, seed, save_path):
+    import torch
+    from sklearn.model_selection import train_test_split
+    from torch_geometric.transforms import RandomNodeSplit
+
+    from gnn4bcprediction.pyg_dataset import CollatedDataset, collated_path
+
+    torch.set_default_tensor_type(torch.FloatTensor)
+    torch.manual_seed(seed)
+
+    if per_val > 0 or per_test > 0:
+        full_data = [RandomNodeSplit(num_val=per_val, num_test=per_test)(data)
+                     for data in full_data]
+
     os.makedirs(os.path.dirname(save_path), exist_ok=True)
     if per_val > 0 or per_test > 0:
         temp_data, test_data = train_test_split(full_data, test_size=per_test,
@@ -124,58 +473,162 @@ def create_pygdataset(graphs, per_val, per_test, seed, save_path):
         train_data, val_data = train_test_split(temp_data, test_size=per_val,
                                                 random_state=seed)
 
-        torch.save(train_data, f'{save_path}_train.pt')
-        torch.save(test_data, f'{save_path}_test.pt')
-        torch.save(val_data, f'{save_path}_val.pt')
+        CollatedDataset.save(train_data, collated_path(f'{save_path}_train'))
+        CollatedDataset.save(test_data, collated_path(f'{save_path}_test'))
+        CollatedDataset.save(val_data, collated_path(f'{save_path}_val'))
 
     else:
-        torch.save(full_data, f'{save_path}.pt')
+        CollatedDataset.save(full_data, collated_path(save_path))
 
     return full_data
 
 
 def create_datasets(topologies, top_names, dataset_name, steps, mc, per_val,
                     per_test, num_configs, seed, max_threshold=0.5, mix=True,
-                    communities=False, save_nx=False):
-    generator = random.Random(seed)
+                    communities=False, save_nx=False, ensemble=False,
+                    mode='async', tolerance=None, window=None, sweep=True,
+                    cache=None, from_arrays=False):
+    # Independent random streams for the initial opinions and the simulations
+    # of each topology
+    topology_seeds = [spawn_seeds(topology_seed, 2) for topology_seed in
+                      spawn_seeds(seed, len(topologies))]
     initial_opinions = [
-        generate_random_uniform_values(topology.number_of_nodes(),
-                                       generator=generator) for topology in
-        topologies]
+        generate_random_uniform_values(
+            topology.number_of_nodes(),
+            generator=np.random.default_rng(topology_seeds[i][0])) for
+        i, topology in enumerate(topologies)]
     thr_scenario = 'com' if communities else 'hom'
     datasets_path = f'data/datasets/'
     sim_attributes = f'{steps}_{mc}_{num_configs}_{max_threshold}_{thr_scenario}'
+    if mode == 'sync':
+        sim_attributes = f'{sim_attributes}_sync'
+
+    # Long-lived workers for the replicas simulated one by one
+    if mode == 'async' and not ensemble:
+        pool_context = SimulationPool()
+    else:
+        pool_context = nullcontext()
+
+    if save_nx:
+        save_paths = [f'data/nx_graphs/{top_names[i]}_{sim_attributes}'
+                      for i in range(len(topologies))]
+    else:
+        save_paths = [None] * len(topologies)
+
+    def pyg_path(name):
+        path = f'{datasets_path}{name}/{name}_{sim_attributes}'
+        if per_val != 0 or per_test != 0:
+            path = f'{path}_{per_val}-{per_test}'
+        return path
+
+    # The networkx graphs need every config of their topology, so the results
+    # are only kept to save them or to build the PyG datasets from them
+    keep_results = save_nx or not from_arrays
+    results = [([None] * num_configs, [None] * num_configs)
+               for _ in topologies]
+
+    writers = []
+    if from_arrays:
+        from gnn4bcprediction.pyg_dataset import DatasetWriter
+
+        # Every config gives a PyG graph per connected component, in the
+        # order of the topologies, their configs and their components
+        num_components = [
+            topology.number_of_components() if isinstance(topology, Topology)
+            else nx.number_connected_components(topology)
+            for topology in topologies]
+        if mix:
+            # Each topology has its own shards, so the graphs of a topology
+            # are never held for those of a slower one
+            offsets = np.cumsum([0] + num_components[:-1]) * num_configs
+            writers = [DatasetWriter(
+                pyg_path(dataset_name),
+                num_configs * sum(num_components), per_val=per_val,
+                per_test=per_test, seed=seed,
+                streams=offsets.tolist())] * len(topologies)
+        else:
+            writers = [DatasetWriter(
+                pyg_path(top_names[i]), num_configs * num_components[i],
+                per_val=per_val, per_test=per_test, seed=seed)
+                for i in range(len(topologies))]
+            offsets = [0] * len(topologies)
+
+    # Edge indices of the topologies with configs still being simulated
+    topology_data = {}
+    remaining = [num_configs] * len(topologies)
+
+    def consume(i, c, threshold_bc, mean_final_opinions):
+        if keep_results:
+            results[i][0][c] = threshold_bc
+            results[i][1][c] = mean_final_opinions
+
+        if from_arrays:
+            # Write the PyG data of each config as soon as it finishes
+            if i not in topology_data:
+                topology_data[i] = build_topology_data(topologies[i])
+            first = offsets[i] + c * num_components[i]
+            for k, data in enumerate(build_attribute_data(
+                    topology_data[i], initial_opinions[i],
+                    mean_final_opinions, threshold_bc, steps, mc)):
+                writers[i].write(first + k, data)
+
+            remaining[i] -= 1
+            if not remaining[i]:
+                del topology_data[i]
+                if not mix:
+                    writers[i].close()
 
     t1 = time.time()
-    graphs = [generate_multiple_attribute_graph(base_graph=topologies[i],
-                                                initial_opinions=
-                                                initial_opinions[i],
-                                                simulation_steps=steps, mc=mc,
-                                                num_graphs=num_configs,
-                                                max_threshold=max_threshold,
-                                                communities=communities,
-                                                generator=generator,
-                                                save_path=f'data/nx_graphs/{top_names[i]}_{sim_attributes}.json' if save_nx else None)
-              for i in range(len(topologies))]
+    with pool_context as pool:
+        if pool is not None and sweep:
+            # Schedule the replicas of all topologies and configs at once
+            simulate_sweep_configs(
+                topologies=topologies, initial_opinions=initial_opinions,
+                simulation_steps=steps, mc=mc, num_graphs=num_configs,
+                max_threshold=max_threshold, pool=pool,
+                communities=communities,
+                seeds=[topology_seed[1] for topology_seed in topology_seeds],
+                tolerance=tolerance, window=window, cache=cache,
+                callback=consume)
+        else:
+            for i in range(len(topologies)):
+                simulate_multiple_configs(
+                    base_graph=topologies[i],
+                    initial_opinions=initial_opinions[i],
+                    simulation_steps=steps, mc=mc, num_graphs=num_configs,
+                    max_threshold=max_threshold, communities=communities,
+                    seed=topology_seeds[i][1], ensemble=ensemble, mode=mode,
+                    tolerance=tolerance, window=window, pool=pool,
+                    cache=cache,
+                    callback=lambda c, threshold_bc, mean_final_opinions:
+                    consume(i, c, threshold_bc, mean_final_opinions))
+
+    if from_arrays and mix:
+        writers[0].close()
+
+    if keep_results:
+        graphs = [
+            build_multiple_attribute_graph(
+                topologies[i], initial_opinions[i], results[i][0],
+                results[i][1], steps, mc, save_paths[i])
+            for i in range(len(topologies))]
     t2 = time.time()
 
     print(f'Graph generation time: {t2 - t1}')
 
+    if from_arrays:
+        return
+
     t1 = time.time()
 
     if mix:
-        pyg_path = f'{datasets_path}{dataset_name}/{dataset_name}_{sim_attributes}'
-        if per_val != 0 or per_test != 0:
-            pyg_path = f'{pyg_path}_{per_val}-{per_test}'
         create_pygdataset(graphs, per_val=per_val, per_test=per_test,
-                          seed=seed, save_path=pyg_path)
+                          seed=seed, save_path=pyg_path(dataset_name))
     else:
-        for i, graph in enumerate(graphs):
-            pyg_path = f'{datasets_path}{top_names[i]}/{top_names[i]}_{sim_attributes}'
-            if per_val != 0 or per_test != 0:
-                pyg_path = f'{pyg_path}_{per_val}-{per_test}'
-            create_pygdataset([graph], per_val=per_val, per_test=per_test,
-                              seed=seed, save_path=pyg_path)
+        for i in range(len(topologies)):
+            create_pygdataset([graphs[i]], per_val=per_val,
+                              per_test=per_test, seed=seed,
+                              save_path=pyg_path(top_names[i]))
 
     t2 = time.time()
 
@@ -4,22 +4,51 @@ import time
 
 import numpy as np
 import torch
-from matplotlib import pyplot as plt
+from torch.utils.data import RandomSampler
+from torch_geometric.data import Batch
+
+from gnn4bcprediction.checkpoint import Checkpointer, snapshot_state
+from gnn4bcprediction.nn_models import compile_model
+
+
+# Floating type of the node features of the datasets in each precision
+feature_dtypes = {'float32': torch.float32, 'bfloat16': torch.bfloat16}
+
+
+def autocast(precision, device_type='cpu'):
+    """Context of the forward and backward passes of a model in a precision:
+    'float32', or 'bfloat16' autocast, with the parameters, their gradients
+    and the loss in float32."""
+    return torch.autocast(device_type, dtype=torch.bfloat16,
+                          enabled=precision == 'bfloat16')
+
+
+def seed_predictions(y_pred, batch):
+    """Predictions and targets of the nodes of a batch that are evaluated:
+    all of them, or the seed nodes of a subgraph sampled around them
+    (``NeighborSampledLoader``), which come first."""
+    if 'batch_size' in batch:
+        return y_pred.reshape(-1)[:batch.batch_size], \
+            batch.y[:batch.batch_size]
+    return y_pred, batch.y
 
 
 @torch.no_grad()
-def test_torch(model, data_loader, loss_fn, gnn=True):
+def test_torch(model, data_loader, loss_fn, gnn=True, precision='float32'):
     model.eval()
 
     total_loss = 0
 
     for batch in data_loader:
-        if gnn:
-            y_pred = torch.squeeze(model.forward(batch.x, batch.edge_index))
-        else:
-            y_pred = torch.squeeze(model.forward(batch.x))
-
-        loss = loss_fn(y_pred, batch.y).item()
+        with autocast(precision, batch.x.device.type):
+            if gnn:
+                y_pred = torch.squeeze(model(batch.x, batch.edge_index))
+            else:
+                y_pred = torch.squeeze(model(batch.x))
+
+        # The loss is computed in float32 in any precision
+        y_pred, y_true = seed_predictions(y_pred.float(), batch)
+        loss = loss_fn(y_pred, y_true).item()
         total_loss += loss * batch.num_graphs
 
     total_loss = total_loss / len(data_loader.dataset)
@@ -28,36 +57,42 @@ def test_torch(model, data_loader, loss_fn, gnn=True):
 
 
 @torch.no_grad()
-def test_sklearn(model, data_loader, loss_fn, gnn=True):
+def test_sklearn(model, data_loader, loss_fn, gnn=True, precision='float32'):
     model.eval()
 
     y_true = np.array([])
     y_pred = np.array([])
 
     for batch in data_loader:
-        if gnn:
-            new_pred = torch.squeeze(model.forward(batch.x, batch.edge_index))
-        else:
-            new_pred = torch.squeeze(model.forward(batch.x))
-
-        y_true = np.append(y_true, batch.y.detach().cpu().numpy())
+        with autocast(precision, batch.x.device.type):
+            if gnn:
+                new_pred = torch.squeeze(model(batch.x, batch.edge_index))
+            else:
+                new_pred = torch.squeeze(model(batch.x))
+
+        new_pred, new_true = seed_predictions(new_pred.float(), batch)
+        y_true = np.append(y_true, new_true.detach().cpu().numpy())
         y_pred = np.append(y_pred, new_pred.detach().cpu().numpy())
 
     return loss_fn(y_true, y_pred)
 
 
-def train_epoch(model, train_data_loader, optimizer, loss_fn, gnn=True):
+def train_epoch(model, train_data_loader, optimizer, loss_fn, gnn=True,
+                precision='float32'):
     total_loss = 0
     model.train()
 
     for batch in train_data_loader:
         optimizer.zero_grad()
-        if gnn:
-            out = torch.squeeze(model.forward(batch.x, batch.edge_index))
-        else:
-            out = torch.squeeze(model.forward(batch.x))
+        with autocast(precision, batch.x.device.type):
+            if gnn:
+                out = torch.squeeze(model(batch.x, batch.edge_index))
+            else:
+                out = torch.squeeze(model(batch.x))
 
-        loss = loss_fn(out, batch.y)
+        # The loss is computed in float32 in any precision
+        out, y_true = seed_predictions(out.float(), batch)
+        loss = loss_fn(out, y_true)
 
         loss.backward()
         optimizer.step()
@@ -69,65 +104,442 @@ def train_epoch(model, train_data_loader, optimizer, loss_fn, gnn=True):
     return total_loss
 
 
+class CachedBatchLoader:
+    """Loader that collates the batches of a dataset once and yields the same
+    batches in every epoch.
+
+    Shuffling only permutes the order of the batches, whose graphs are drawn
+    at random when they are built, so no ``Batch`` is rebuilt during
+    training.
+
+    Parameters
+    ----------
+    dataset : Dataset or list
+        Graphs of the dataset.
+    batch_size : int
+        Number of graphs of each batch, or None for a single batch with the
+        disjoint union of all the graphs.
+    shuffle : bool
+        Whether to shuffle the graphs of the batches and their order.
+    """
+
+    def __init__(self, dataset, batch_size=None, shuffle=False):
+        self.dataset = dataset
+        self.shuffle = shuffle
+
+        if batch_size is None:
+            batch_size = len(dataset)
+        indices = torch.randperm(len(dataset)) if shuffle else \
+            torch.arange(len(dataset))
+        self.batches = [Batch.from_data_list(
+            [dataset[int(i)] for i in indices[start:start + batch_size]])
+            for start in range(0, len(dataset), batch_size)]
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        if self.shuffle:
+            order = torch.randperm(len(self.batches)).tolist()
+        else:
+            order = range(len(self.batches))
+        for i in order:
+            yield self.batches[i]
+
+
+def cache_batches(data_loader, full_batch=False):
+    """Build the CachedBatchLoader of a DataLoader, with its batch size (or a
+    single batch) and its shuffling."""
+    return CachedBatchLoader(
+        data_loader.dataset, None if full_batch else data_loader.batch_size,
+        shuffle=isinstance(data_loader.sampler, RandomSampler))
+
+
 def train_model(original_model, train_data_loader, val_data_loader, optimizer,
                 loss_fn, lr, epochs, early_stopping_steps, is_gnn=True,
-                results_file=None, model_file=None):
+                results_file=None, model_file=None, batching='loader',
+                eval_every=1, fused_train_loss=False, checkpoint_file=None,
+                checkpoint_every=100, compiled=False, keep_checkpoint=False,
+                precision='float32'):
+    # The batches of the train and validation splits can be collated once
+    # ('cached'), or as a single disjoint-union graph per split ('full')
+    if batching != 'loader':
+        train_data_loader = cache_batches(train_data_loader,
+                                          batching == 'full')
+        val_data_loader = cache_batches(val_data_loader, batching == 'full')
+
     model = copy.deepcopy(original_model)
+    if compiled:
+        compile_model(model)
     optimizer = optimizer(model.parameters(), lr=lr)
-    best_model = None
+    # Parameters of the best model, copied in place when it improves
+    best_state = None
     best_valid_loss = float('inf')
+    # Evaluation rounds without improvement
     no_improvement = 0
-
-    train_losses, valid_losses = [], []
+    first_epoch = 0
+    stopped = False
+
+    train_losses, valid_losses, eval_epochs = [], [], []
+    print_every = max(1, 100 // eval_every)
+
+    # Resume from the last checkpoint of an interrupted run
+    checkpointer = None
+    if checkpoint_file is not None:
+        checkpointer = Checkpointer(checkpoint_file)
+        checkpoint = checkpointer.load()
+        if checkpoint is not None:
+            model.load_state_dict(checkpoint['model'])
+            optimizer.load_state_dict(checkpoint['optimizer'])
+            best_state = checkpoint['best_model']
+            best_valid_loss = checkpoint['best_valid_loss']
+            no_improvement = checkpoint['no_improvement']
+            train_losses = checkpoint['train_losses']
+            valid_losses = checkpoint['valid_losses']
+            eval_epochs = checkpoint['eval_epochs']
+            torch.set_rng_state(checkpoint['rng_state'])
+            first_epoch = checkpoint['epoch'] + 1
+            stopped = checkpoint.get('stopped', False)
+            print(f'Resuming from epoch {first_epoch}')
+
+    def training_state(epoch):
+        return {'epoch': epoch, 'model': model.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'best_model': best_state, 'best_valid_loss': best_valid_loss,
+                'no_improvement': no_improvement,
+                'train_losses': train_losses, 'valid_losses': valid_losses,
+                'eval_epochs': eval_epochs, 'stopped': stopped,
+                'rng_state': torch.get_rng_state()}
 
     initial_time = time.time()
 
-    for epoch in range(epochs):
-        loss = train_epoch(model, train_data_loader, optimizer, loss_fn,
-                           is_gnn)
-        train_loss = test_torch(model, train_data_loader, loss_fn, is_gnn)
-        valid_loss = test_torch(model, val_data_loader, loss_fn, is_gnn)
-
-        train_losses.append(train_loss)
-        valid_losses.append(valid_loss)
-
-        if valid_loss < best_valid_loss:
-            best_valid_loss = valid_loss
-            best_model = copy.deepcopy(model)
-            no_improvement = 0
-
-        elif no_improvement > early_stopping_steps:
-            print(f'Early stopping! (epochs: {epoch})')
+    last_epoch = first_epoch - 1
+    for epoch in range(first_epoch, epochs):
+        # Runs resumed after stopping early are not trained further
+        if stopped:
             break
-        else:
-            no_improvement += 1
+        last_epoch = epoch
 
-        if epoch % 100 == 0:
-            print(f'Epoch: {epoch:02d}, '
-                  f'Loss: {loss:.4f}, '
-                  f'Train: {train_loss:.4f}, '
-                  f'Valid: {valid_loss:.4f}')
+        loss = train_epoch(model, train_data_loader, optimizer, loss_fn,
+                           is_gnn, precision)
+
+        # The model is evaluated every eval_every epochs
+        if epoch % eval_every == 0:
+            # The loss accumulated during the training pass can be reported
+            # instead of making a second pass over the training set
+            if fused_train_loss:
+                train_loss = loss
+            else:
+                train_loss = test_torch(model, train_data_loader, loss_fn,
+                                        is_gnn, precision)
+            valid_loss = test_torch(model, val_data_loader, loss_fn, is_gnn,
+                                    precision)
+
+            train_losses.append(train_loss)
+            valid_losses.append(valid_loss)
+            eval_epochs.append(epoch)
+
+            if valid_loss < best_valid_loss:
+                best_valid_loss = valid_loss
+                best_state = snapshot_state(model.state_dict(), best_state)
+                no_improvement = 0
+
+            elif no_improvement > early_stopping_steps:
+                print(f'Early stopping! (epochs: {epoch})')
+                stopped = True
+                break
+            else:
+                no_improvement += 1
+
+            if (len(eval_epochs) - 1) % print_every == 0:
+                print(f'Epoch: {epoch:02d}, '
+                      f'Loss: {loss:.4f}, '
+                      f'Train: {train_loss:.4f}, '
+                      f'Valid: {valid_loss:.4f}')
+
+        if checkpointer is not None and (epoch + 1) % checkpoint_every == 0:
+            checkpointer.save(training_state(epoch))
 
     ending_time = time.time()
 
     print('Training time: ', ending_time - initial_time)
 
+    best_model = None
+    if best_state is not None:
+        best_model = copy.deepcopy(model)
+        best_model.load_state_dict(best_state)
+        best_model.eval()
+
     if results_file is not None:
         os.makedirs(os.path.dirname(results_file), exist_ok=True)
-        save_training_results(train_losses, valid_losses, results_file)
+        save_training_results(train_losses, valid_losses, results_file,
+                              eval_epochs)
 
     if model_file is not None:
         os.makedirs(os.path.dirname(model_file), exist_ok=True)
         torch.save(best_model.state_dict(), model_file)
         print(f'Training ended for model {model_file}')
 
+    # A complete run is not resumed, unless it is to be trained for more
+    # epochs later (e.g. by successive halving)
+    if checkpointer is not None and keep_checkpoint:
+        checkpointer.save(training_state(last_epoch))
+        checkpointer.wait()
+    elif checkpointer is not None:
+        checkpointer.remove()
+
     return best_model
 
 
-def save_training_results(train_losses, valid_losses, save_file):
+class StackedAdam:
+    """Adam optimizer of the stacked parameters of several models, with a
+    learning rate and a state per model.
+
+    The update of each model is the same as that of ``torch.optim.Adam``
+    with its default arguments, and the models that are not active (e.g.
+    stopped early) are left unchanged.
+
+    Parameters
+    ----------
+    params : dict
+        Stacked parameters, with the models along the first dimension.
+    lrs : list[float]
+        Learning rate of each model.
+    betas : tuple[float, float]
+        Coefficients of the running averages of the gradient and its square.
+    eps : float
+        Term added to the denominator for numerical stability.
+    """
+
+    def __init__(self, params, lrs, betas=(0.9, 0.999), eps=1e-8):
+        self.params = params
+        self.betas = betas
+        self.eps = eps
+
+        device = next(iter(params.values())).device
+        self.lrs = torch.as_tensor(lrs, dtype=torch.float64, device=device)
+        self.steps = torch.zeros(len(lrs), dtype=torch.float64, device=device)
+        self.exp_avg = {name: torch.zeros_like(p) for name, p in
+                        params.items()}
+        self.exp_avg_sq = {name: torch.zeros_like(p) for name, p in
+                           params.items()}
+
+    def zero_grad(self):
+        for p in self.params.values():
+            p.grad = None
+
+    @torch.no_grad()
+    def step(self, active):
+        beta1, beta2 = self.betas
+        self.steps += active
+        bias_correction1 = 1 - beta1 ** self.steps
+        bias_correction2_sqrt = (1 - beta2 ** self.steps).sqrt()
+        step_size = self.lrs / bias_correction1
+
+        for name, p in self.params.items():
+            if p.grad is None:
+                continue
+            shape = (-1,) + (1,) * (p.dim() - 1)
+            mask = active.view(shape)
+            exp_avg, exp_avg_sq = self.exp_avg[name], self.exp_avg_sq[name]
+
+            exp_avg.copy_(torch.where(mask, exp_avg.lerp(p.grad, 1 - beta1),
+                                      exp_avg))
+            exp_avg_sq.copy_(torch.where(
+                mask, exp_avg_sq * beta2 + (1 - beta2) * p.grad * p.grad,
+                exp_avg_sq))
+
+            denom = exp_avg_sq.sqrt() / bias_correction2_sqrt.to(
+                p.dtype).view(shape) + self.eps
+            update = step_size.to(p.dtype).view(shape) * exp_avg / denom
+            p.sub_(torch.where(mask, update, 0))
+
+
+def train_models(original_models, train_data_loader, val_data_loader,
+                 loss_fn, lrs, epochs, early_stopping_steps, is_gnn=True,
+                 results_files=None, model_files=None, batching='loader',
+                 eval_every=1, fused_train_loss=False, precision='float32'):
+    """Train several models with the same architecture at once, e.g. the
+    learning rates or seeds of a config.
+
+    The parameters of the models are stacked and all the models are run on
+    each batch by a single vectorized call (``torch.func.vmap``), so the
+    batches are built once for all of them. Each model has its own Adam
+    state, learning rate and early stopping, and it is trained as
+    ``train_model`` would with ``torch.optim.Adam`` and the same batches, up
+    to floating-point differences. Adam amplifies these over training, so
+    the models can drift from separate runs, notably for attention layers
+    (GATv2).
+
+    Parameters
+    ----------
+    original_models : list[torch.nn.Module]
+        Models with the same architecture and their initial parameters.
+    train_data_loader : DataLoader
+        Batches of the train split.
+    val_data_loader : DataLoader
+        Batches of the validation split.
+    loss_fn : callable
+        Loss of the predictions of a batch.
+    lrs : list[float]
+        Learning rate of each model.
+    epochs : int
+        Maximum number of epochs.
+    early_stopping_steps : int
+        Evaluation rounds without improvement before a model stops.
+    is_gnn : bool
+        Whether the models take the edges of the graphs.
+    results_files : list[str]
+        Plots of the loss curves of the models.
+    model_files : list[str]
+        Files of the best parameters of the models.
+    batching : str
+        'loader', 'cached' or 'full', as in ``train_model``.
+    eval_every : int
+        Epochs between evaluations.
+    fused_train_loss : bool
+        Whether to report the train loss accumulated while training.
+    precision : str
+        'float32', or 'bfloat16' to run the models in bfloat16 autocast.
+
+    Returns
+    -------
+    list[torch.nn.Module]
+        Best model of each config.
+    """
+    from torch.func import functional_call, stack_module_state, vmap
+
+    if batching != 'loader':
+        train_data_loader = cache_batches(train_data_loader,
+                                          batching == 'full')
+        val_data_loader = cache_batches(val_data_loader, batching == 'full')
+
+    num_models = len(original_models)
+    params, buffers = stack_module_state(original_models)
+    # Stateless copy of the architecture, run with the parameters of each
+    # model
+    base_model = copy.deepcopy(original_models[0]).to('meta')
+
+    def batch_losses(batch):
+        # Loss of a model on the batch, computed for all the models at once
+        def model_loss(model_params, model_buffers):
+            inputs = (batch.x, batch.edge_index) if is_gnn else (batch.x,)
+            with autocast(precision, batch.x.device.type):
+                out = torch.squeeze(functional_call(
+                    base_model, (model_params, model_buffers), inputs))
+            return loss_fn(*seed_predictions(out.float(), batch))
+
+        return vmap(model_loss)(params, buffers)
+
+    @torch.no_grad()
+    def test_models(data_loader):
+        total_loss = 0
+        for batch in data_loader:
+            total_loss += batch_losses(batch) * batch.num_graphs
+        return (total_loss / len(data_loader.dataset)).tolist()
+
+    optimizer = StackedAdam(params, lrs)
+    # Parameters of the best model of each config
+    best_params = {name: p.detach().clone() for name, p in params.items()}
+    best_valid_loss = [float('inf')] * num_models
+    no_improvement = [0] * num_models
+    active = torch.ones(num_models, dtype=torch.bool,
+                        device=best_params[next(iter(params))].device)
+
+    train_losses = [[] for _ in range(num_models)]
+    valid_losses = [[] for _ in range(num_models)]
+    eval_epochs = [[] for _ in range(num_models)]
+    print_every = max(1, 100 // eval_every)
+    eval_round = 0
+
+    initial_time = time.time()
+
+    for epoch in range(epochs):
+        if not active.any():
+            break
+
+        # Sum of the losses, whose gradients are those of each model
+        total_loss = 0
+        for batch in train_data_loader:
+            optimizer.zero_grad()
+            losses = batch_losses(batch)
+            losses.sum().backward()
+            optimizer.step(active)
+
+            total_loss += losses.detach() * batch.num_graphs
+        loss = (total_loss / len(train_data_loader.dataset)).tolist()
+
+        if epoch % eval_every != 0:
+            continue
+
+        if fused_train_loss:
+            train_loss = loss
+        else:
+            train_loss = test_models(train_data_loader)
+        valid_loss = test_models(val_data_loader)
+
+        improved = torch.zeros_like(active)
+        for i in active.nonzero().flatten().tolist():
+            train_losses[i].append(train_loss[i])
+            valid_losses[i].append(valid_loss[i])
+            eval_epochs[i].append(epoch)
+
+            if valid_loss[i] < best_valid_loss[i]:
+                best_valid_loss[i] = valid_loss[i]
+                improved[i] = True
+                no_improvement[i] = 0
+            elif no_improvement[i] > early_stopping_steps:
+                print(f'Early stopping of model {i}! (epochs: {epoch})')
+                active[i] = False
+            else:
+                no_improvement[i] += 1
+
+        with torch.no_grad():
+            for name, p in params.items():
+                best_params[name][improved] = p[improved]
+
+        if eval_round % print_every == 0:
+            print(f'Epoch: {epoch:02d}, ' + ', '.join(
+                f'Valid {i}: {valid_loss[i]:.4f}' for i in range(num_models)))
+        eval_round += 1
+
+    ending_time = time.time()
+
+    print('Training time: ', ending_time - initial_time)
+
+    best_models = []
+    for i, original_model in enumerate(original_models):
+        best_model = copy.deepcopy(original_model)
+        with torch.no_grad():
+            for name, p in best_model.named_parameters():
+                p.copy_(best_params[name][i])
+        best_model.eval()
+        best_models.append(best_model)
+
+        if results_files is not None:
+            os.makedirs(os.path.dirname(results_files[i]), exist_ok=True)
+            save_training_results(train_losses[i], valid_losses[i],
+                                  results_files[i], eval_epochs[i])
+
+        if model_files is not None:
+            os.makedirs(os.path.dirname(model_files[i]), exist_ok=True)
+            torch.save(best_model.state_dict(), model_files[i])
+            print(f'Training ended for model {model_files[i]}')
+
+    return best_models
+
+
+def save_training_results(train_losses, valid_losses, save_file,
+                          epochs=None):
+    from matplotlib import pyplot as plt
+
+    # Epochs of the evaluation rounds
+    if epochs is None:
+        epochs = range(len(train_losses))
+
     plt.clf()
-    plt.plot([l for l in train_losses], label='Train')
-    plt.plot([l for l in valid_losses], label='Validation')
+    plt.plot(epochs, [l for l in train_losses], label='Train')
+    plt.plot(epochs, [l for l in valid_losses], label='Validation')
     plt.xlabel('Epoch')
     plt.ylabel('Loss')
     plt.legend()
@@ -0,0 +1,130 @@
+import math
+
+import torch
+from torch_geometric.data import Batch, Data
+
+
+class NeighborSampledLoader:
+    """Loader of the subgraphs sampled around mini-batches of seed nodes,
+    with a fan-out per layer, as ``torch_geometric.loader.NeighborLoader``.
+
+    The seed nodes are all the nodes of the graphs of a dataset, and each
+    subgraph holds them first, followed by the neighbors sampled for each
+    layer, so a model with as many layers as fan-outs computes the
+    predictions of the seed nodes without message passing over the whole
+    graphs. As in NeighborLoader, the number of seed nodes of a subgraph is
+    its ``batch_size`` and its nodes in the dataset are its ``n_id``.
+
+    The ``num_graphs`` of a subgraph is the fraction of the graphs of the
+    dataset its seed nodes cover (``1 / n`` for each seed node of a graph
+    with ``n`` nodes), so the losses of the subgraphs are accumulated as those
+    of the batches of a DataLoader: an epoch covers ``len(dataset)`` graphs.
+
+    Parameters
+    ----------
+    dataset : Dataset or list
+        Graphs of the dataset.
+    num_neighbors : list[int]
+        Number of neighbors sampled for each node at each layer, from the
+        seed nodes outwards, or -1 for all the neighbors. An empty list
+        gives the seed nodes alone (e.g. for an MLP).
+    batch_size : int
+        Number of seed nodes of each subgraph.
+    shuffle : bool
+        Whether to shuffle the seed nodes in every epoch.
+    """
+
+    def __init__(self, dataset, num_neighbors, batch_size=1024,
+                 shuffle=False):
+        self.dataset = dataset
+        self.num_neighbors = list(num_neighbors)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+        # Disjoint union of the graphs, with the in-neighbors of each node in
+        # CSR format
+        graph = Batch.from_data_list([dataset[i] for i in
+                                      range(len(dataset))])
+        self.x = graph.x
+        self.y = graph.y
+        self.num_nodes = graph.num_nodes
+
+        sources, targets = graph.edge_index
+        order = torch.argsort(targets, stable=True)
+        self.neighbors = sources[order]
+        self.rowptr = torch.zeros(self.num_nodes + 1, dtype=torch.long,
+                                  device=self.x.device)
+        self.rowptr[1:] = torch.cumsum(
+            torch.bincount(targets, minlength=self.num_nodes), 0)
+
+        graph_sizes = graph.ptr.diff()
+        self.node_weights = torch.repeat_interleave(
+            1 / graph_sizes.double(), graph_sizes)
+
+        # Position of each node in the subgraph being sampled, or -1
+        self._local = torch.full((self.num_nodes,), -1, dtype=torch.long,
+                                 device=self.x.device)
+
+    def __len__(self):
+        return math.ceil(self.num_nodes / self.batch_size)
+
+    def __iter__(self):
+        if self.shuffle:
+            seeds = torch.randperm(self.num_nodes, device=self.x.device)
+        else:
+            seeds = torch.arange(self.num_nodes, device=self.x.device)
+        for start in range(0, self.num_nodes, self.batch_size):
+            yield self.sample(seeds[start:start + self.batch_size])
+
+    def sample(self, seeds):
+        """Sample the subgraph of a tensor of seed nodes."""
+        n_id = seeds
+        self._local[seeds] = torch.arange(len(seeds), device=seeds.device)
+        rows, cols = [], []
+
+        frontier = seeds
+        for num_neighbors in self.num_neighbors:
+            sources, targets = self._sample_neighbors(frontier, num_neighbors)
+            # Nodes already in the subgraph are not sampled again
+            new_nodes = torch.unique(sources[self._local[sources] < 0])
+            self._local[new_nodes] = torch.arange(
+                len(n_id), len(n_id) + len(new_nodes), device=seeds.device)
+            n_id = torch.cat([n_id, new_nodes])
+
+            rows.append(self._local[sources])
+            cols.append(self._local[targets])
+            frontier = new_nodes
+
+        self._local[n_id] = -1
+
+        if rows:
+            edge_index = torch.stack([torch.cat(rows), torch.cat(cols)])
+        else:
+            edge_index = torch.empty((2, 0), dtype=torch.long,
+                                     device=seeds.device)
+
+        return Data(x=self.x[n_id], edge_index=edge_index, y=self.y[n_id],
+                    n_id=n_id, batch_size=len(seeds),
+                    num_graphs=self.node_weights[seeds].sum().item())
+
+    def _sample_neighbors(self, nodes, num_neighbors):
+        # In-edges of the nodes, grouped by node
+        starts = self.rowptr[nodes]
+        degrees = self.rowptr[nodes + 1] - starts
+        group = torch.repeat_interleave(
+            torch.arange(len(nodes), device=nodes.device), degrees)
+        offsets = torch.cumsum(degrees, 0) - degrees
+        rank = torch.arange(len(group), device=nodes.device) - offsets[group]
+
+        if num_neighbors < 0:
+            edges = starts[group] + rank
+        else:
+            # A random order of the in-edges of each node, of which the first
+            # num_neighbors are kept
+            order = torch.argsort(torch.rand(len(group), device=nodes.device))
+            order = order[torch.argsort(group[order], stable=True)]
+            kept = order[rank < num_neighbors]
+            edges = (starts[group] + rank)[kept]
+            group = group[kept]
+
+        return self.neighbors[edges], nodes[group]
@@ -1,5 +1,3 @@
-import copy
-
 import torch
 from torch.nn import Linear
 from torch.nn.functional import relu, sigmoid
@@ -26,7 +24,7 @@ class SequentialLayersWithActivation(torch.nn.Module):
             layer.reset_parameters()
 
     def forward(self, x, edge_index=None):
-        h = copy.deepcopy(x)
+        h = x
 
         for i, layer in enumerate(self.layers):
             if edge_index is None:
@@ -65,3 +63,32 @@ class MLP(SequentialLayersWithActivation):
     def __init__(self, input_dim, hidden_dim, output_dim, num_hidden_layers):
         super(MLP, self).__init__(Linear, relu, input_dim, hidden_dim,
                                   output_dim, num_hidden_layers)
+
+
+def compile_model(model):
+    """Compile the forward pass of a model in place with ``torch.compile``.
+
+    Shapes are dynamic, since every batch has a different number of nodes and
+    edges. The model keeps its parameters and state dict keys, so it can be
+    trained, saved and loaded as the eager model.
+
+    The self-loops handled by the graph layers have data-dependent shapes,
+    and the layers of a model have parameters of different shapes, so both
+    are traced dynamically to avoid graph breaks and recompilations. Since
+    every model class shares the same forward code, the number of compiled
+    versions of each function is also raised. These are global settings of
+    ``torch._dynamo``.
+    """
+    import torch._dynamo
+
+    config = torch._dynamo.config
+    config.capture_dynamic_output_shape_ops = True
+    config.force_parameter_static_shapes = False
+    # The limit was named cache_size_limit before torch 2.6
+    limit_name = 'recompile_limit' if hasattr(config, 'recompile_limit') \
+        else 'cache_size_limit'
+    setattr(config, limit_name, max(getattr(config, limit_name), 64))
+
+    model.compile(dynamic=True)
+
+    return model
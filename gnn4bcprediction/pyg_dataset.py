@@ -0,0 +1,251 @@
+import os
+import re
+
+import numpy as np
+import torch
+from torch.utils.data import ConcatDataset
+from torch_geometric.data import InMemoryDataset
+
+
+class CollatedDataset(InMemoryDataset):
+    """Dataset of PyG graphs stored collated in a single file, with one
+    contiguous tensor per attribute and the slices of each graph.
+
+    The file is memory-mapped when it is loaded, so opening a dataset does
+    not read it whole, and each graph is only built from its slices when it
+    is accessed.
+
+    Parameters
+    ----------
+    path : str
+        File written by ``CollatedDataset.save``.
+    mmap : bool
+        Whether to memory-map the tensors of the file.
+    transform : callable
+        Transform applied to each graph when it is accessed.
+    """
+
+    def __init__(self, path, mmap=True, transform=None):
+        super().__init__(None, transform, log=False)
+
+        # Same format as InMemoryDataset.save, read without copying tensors
+        data, self.slices, data_cls = torch.load(path, mmap=mmap,
+                                                 weights_only=False)
+        self.data = data_cls.from_dict(data)
+
+    def to(self, device):
+        """Move the collated tensors to a device."""
+        self.data = self._data.to(device)
+        self._data_list = None
+
+        return self
+
+    def cast_features(self, dtype):
+        """Convert the node features to a floating type, e.g. bfloat16 to
+        halve their memory."""
+        self._data.x = self._data.x.to(dtype)
+        self._data_list = None
+
+        return self
+
+
+def collated_path(path, shard=None):
+    """Path of the collated file of a dataset split, or of one of its shards.
+    """
+    if shard is None:
+        return f'{path}.collated.pt'
+    return f'{path}.{shard}.collated.pt'
+
+
+def split_path(file):
+    """Path of the dataset split of a collated, sharded or list file."""
+    return re.sub(r'(\.\d+)?(\.collated)?\.pt$', '', file)
+
+
+class DatasetWriter:
+    """Writer of the splits of a dataset as its graphs are produced, in any
+    order, to sharded collated files.
+
+    The split of every graph is decided up front from its index, as
+    ``train_test_split`` would split the list of all the graphs, so only the
+    graphs of the shards being filled are kept in memory. The graphs of each
+    split are written in the order of their indices (not in the shuffled
+    order of ``train_test_split``): those written before the graphs that
+    precede them are held until these arrive, so the files do not depend on
+    the order in which the graphs are produced.
+
+    The indices can be divided into streams (e.g. the graphs of each
+    topology of a mixed dataset), each with its own shards, so that a graph
+    is only held for the graphs of its own stream. The shards of every
+    stream are numbered up front, so the files are the same whatever the
+    order in which the streams are produced, and the last shard of a stream
+    is written as soon as the stream is complete.
+
+    Parameters
+    ----------
+    path : str
+        Path of the dataset, without the split and the extension.
+    num_graphs : int
+        Number of graphs of the dataset.
+    per_val : float
+        Fraction of validation graphs and nodes.
+    per_test : float
+        Fraction of test graphs and nodes.
+    seed : int
+        Seed of the splits.
+    shard_size : int
+        Number of graphs of each shard.
+    streams : list[int]
+        First index of each stream (a single stream by default).
+    """
+
+    def __init__(self, path, num_graphs, per_val=0, per_test=0, seed=0,
+                 shard_size=1000, streams=None):
+        from sklearn.model_selection import train_test_split
+
+        self.per_val = per_val
+        self.per_test = per_test
+        self.seed = seed
+        self.shard_size = shard_size
+
+        self._split = np.full(num_graphs, '', dtype=object)
+        if per_val > 0 or per_test > 0:
+            temp_graphs, test_graphs = train_test_split(
+                np.arange(num_graphs), test_size=per_test, random_state=seed)
+            train_graphs, val_graphs = train_test_split(
+                temp_graphs, test_size=per_val, random_state=seed)
+            self._split[train_graphs] = '_train'
+            self._split[test_graphs] = '_test'
+            self._split[val_graphs] = '_val'
+
+        self._paths = {split: f'{path}{split}' for split in
+                       set(self._split.tolist())}
+
+        if streams is None:
+            streams = [0]
+        self._stream = np.searchsorted(streams, np.arange(num_graphs),
+                                       side='right') - 1
+
+        # For the graphs of each split and stream: the position of every
+        # graph, the number of graphs, the first shard, the next position to
+        # write and the graphs that arrived before it
+        self._position = np.empty(num_graphs, dtype=np.int64)
+        self._sizes = {}
+        self._shards = {}
+        for split in sorted(self._paths):
+            first_shard = 0
+            for stream in range(len(streams)):
+                graphs = np.flatnonzero((self._split == split) &
+                                        (self._stream == stream))
+                self._position[graphs] = np.arange(len(graphs))
+                self._sizes[split, stream] = len(graphs)
+                self._shards[split, stream] = first_shard
+                first_shard += -(-len(graphs) // shard_size)
+        self._next = {key: 0 for key in self._sizes}
+        self._pending = {key: {} for key in self._sizes}
+        self._buffers = {key: [] for key in self._sizes}
+
+        # Files of a previous run of the same dataset
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        for old_path in self._paths.values():
+            if os.path.exists(collated_path(old_path)):
+                os.remove(collated_path(old_path))
+            shard = 0
+            while os.path.exists(collated_path(old_path, shard)):
+                os.remove(collated_path(old_path, shard))
+                shard += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, index, data):
+        """Add the graph with an index to its split, writing the shard of the
+        split when it is full."""
+        from torch_geometric.transforms import RandomNodeSplit
+
+        key = (self._split[index], self._stream[index])
+        if self.per_val > 0 or self.per_test > 0:
+            # Node splits only depend on the seed and the index of the graph
+            torch.manual_seed(int(np.random.SeedSequence(
+                self.seed, spawn_key=(index,)).generate_state(1)[0]))
+            data = RandomNodeSplit(num_val=self.per_val,
+                                   num_test=self.per_test)(data)
+
+        pending = self._pending[key]
+        pending[self._position[index]] = data
+        while self._next[key] in pending:
+            self._buffers[key].append(pending.pop(self._next[key]))
+            self._next[key] += 1
+            if len(self._buffers[key]) >= self.shard_size or \
+                    self._next[key] == self._sizes[key]:
+                self._flush(key)
+
+    def close(self):
+        """Write the graphs of the shards that are not full."""
+        for key in self._buffers:
+            # Graphs held for others that were never written
+            pending = self._pending[key]
+            for position in sorted(pending):
+                self._buffers[key].append(pending.pop(position))
+                if len(self._buffers[key]) >= self.shard_size:
+                    self._flush(key)
+            self._flush(key)
+
+    def _flush(self, key):
+        if self._buffers[key]:
+            CollatedDataset.save(self._buffers[key], collated_path(
+                self._paths[key[0]], self._shards[key]))
+            self._shards[key] += 1
+            self._buffers[key] = []
+
+
+def load_dataset(path, device='cpu', mmap=True, features_dtype=None):
+    """Load a dataset split saved with ``save_pygdataset`` or
+    ``DatasetWriter``.
+
+    Parameters
+    ----------
+    path : str
+        Path of the split without extension, e.g.
+        ``data/datasets/synthetic/{dataset_name}_0.2-0.2_train``.
+    device : str
+        Device of the graphs.
+    mmap : bool
+        Whether to memory-map the collated files.
+    features_dtype : torch.dtype
+        Floating type of the node features (e.g. ``torch.bfloat16``), or None
+        to keep the type they were saved with. The targets are not converted.
+
+    Returns
+    -------
+    Dataset or list
+        Collated dataset, concatenation of the collated datasets of its
+        shards, or the list of graphs of datasets saved before the collated
+        format.
+    """
+    def prepare(dataset):
+        if device != 'cpu':
+            dataset = dataset.to(device)
+        if features_dtype is not None:
+            dataset = dataset.cast_features(features_dtype)
+        return dataset
+
+    if os.path.exists(collated_path(path)):
+        return prepare(CollatedDataset(collated_path(path), mmap=mmap))
+
+    if os.path.exists(collated_path(path, 0)):
+        shards = []
+        while os.path.exists(collated_path(path, len(shards))):
+            shards.append(prepare(CollatedDataset(
+                collated_path(path, len(shards)), mmap=mmap)))
+        return ConcatDataset(shards)
+
+    dataset = [data.to(device) for data in
+               torch.load(f'{path}.pt', weights_only=False)]
+    if features_dtype is not None:
+        for data in dataset:
+            data.x = data.x.to(features_dtype)
+    return dataset
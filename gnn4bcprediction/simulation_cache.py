@@ -0,0 +1,118 @@
+import hashlib
+import os
+
+import numpy as np
+
+from gnn4bcprediction.bc_models import graph_to_csr
+
+
+class SimulationCache:
+    """Directory with the final opinions of simulations, stored by a hash of
+    everything that determines them.
+
+    Each entry keeps the final opinions and the number of simulated steps of
+    the replicas of one threshold config. Entries are written atomically, so
+    an interrupted run can resume from the ones already stored, and the least
+    recently used entries are removed when the directory grows above
+    ``max_size`` bytes.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the cache.
+    max_size : int
+        Maximum size of the cache in bytes.
+    """
+
+    def __init__(self, path='data/simulation_cache', max_size=2 ** 30):
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def key(model, graph, initial_op, threshold_bc, simulation_steps, seed,
+            mc=1, seeding=None, tolerance=None, window=None):
+        """Hash of the inputs of a simulation.
+
+        Returns
+        -------
+        str
+            Hexadecimal SHA-256 digest.
+        """
+        digest = hashlib.sha256()
+
+        def update(value):
+            if isinstance(value, np.ndarray):
+                digest.update(value.dtype.str.encode())
+                digest.update(str(value.shape).encode())
+                digest.update(np.ascontiguousarray(value).tobytes())
+            else:
+                digest.update(repr(value).encode())
+            digest.update(b'|')
+
+        # The same integer seed and SeedSequence give the same streams
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+
+        indptr, indices = graph_to_csr(graph)
+        update(model)
+        update(indptr)
+        update(indices)
+        update(np.asarray(initial_op, dtype=float))
+        update(np.asarray(threshold_bc, dtype=float))
+        update(None if seeding is None else np.asarray(seeding,
+                                                       dtype=np.int64))
+        update((simulation_steps, mc, tolerance, window))
+        update((seed.entropy, seed.spawn_key, seed.pool_size))
+
+        return digest.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, f'{key}.npz')
+
+    def get(self, key):
+        """Get the final opinions and the steps of a simulation.
+
+        Returns
+        -------
+        tuple
+            Final opinions of each replica and number of simulated steps of
+            each replica, or None if the simulation is not cached.
+        """
+        try:
+            with np.load(self._file(key)) as entry:
+                final_opinions = list(entry['final_opinions'])
+                steps = entry['steps'].tolist()
+        except FileNotFoundError:
+            return None
+
+        # Mark the entry as recently used
+        os.utime(self._file(key))
+
+        return final_opinions, steps
+
+    def put(self, key, final_opinions, steps):
+        """Store the final opinions and the steps of a simulation."""
+        temp_file = os.path.join(self.path, f'{key}.{os.getpid()}.tmp')
+        with open(temp_file, 'wb') as f:
+            np.savez(f, final_opinions=np.asarray(final_opinions, dtype=float),
+                     steps=np.asarray(steps, dtype=np.int64))
+        os.replace(temp_file, self._file(key))
+
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in
+        its maximum size."""
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith('.npz'):
+                stat = os.stat(os.path.join(self.path, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, name in sorted(entries):
+            if size <= self.max_size:
+                break
+            os.remove(os.path.join(self.path, name))
+            size -= entry_size
@@ -0,0 +1,276 @@
+from multiprocessing import Pool, resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from gnn4bcprediction.bc_models import graph_to_csr, spawn_seeds, _hk_steps
+
+# Shared arrays attached by each worker, kept between tasks
+_attached = {}
+# Lists of neighbors built by each worker for every shared topology
+_neighbors = {}
+# Maximum number of topologies cached by each worker
+_max_topologies = 2
+
+
+class SimulationPool:
+    """Long-lived pool of workers that simulate the HK model on topologies
+    shared through ``multiprocessing.shared_memory``.
+
+    The CSR adjacency and the initial opinions of each topology are copied
+    to shared memory the first time they are used, so later tasks only pass
+    a seed and the handles of the shared arrays to the workers.
+    """
+
+    def __init__(self, processes=None):
+        # Workers must share the resource tracker of this process, otherwise
+        # they would unlink the shared arrays when they exit
+        resource_tracker.ensure_running()
+        self._pool = Pool(processes)
+        # Shared memory blocks by name and handles by shared object
+        self._blocks = {}
+        self._handles = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Stop the workers and release every shared array."""
+        self._pool.close()
+        self._pool.join()
+        for block in self._blocks.values():
+            block.close()
+            block.unlink()
+        self._blocks = {}
+        self._handles = {}
+
+    def share(self, array):
+        """Copy an array to shared memory.
+
+        Returns
+        -------
+        tuple
+            Handle (name, shape, dtype) of the shared array.
+        """
+        array = np.ascontiguousarray(array)
+        block = SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = \
+            array
+        self._blocks[block.name] = block
+
+        return block.name, array.shape, array.dtype.str
+
+    def release(self, handle):
+        """Free a shared array."""
+        block = self._blocks.pop(handle[0])
+        block.close()
+        block.unlink()
+
+    def add_topology(self, graph, initial_op, seeding=None):
+        """Share the CSR adjacency, the initial opinions and the seeding used
+        to simulate on a graph, reusing them if they were already shared.
+
+        Returns
+        -------
+        tuple
+            Handles of the shared indptr, indices, opinions and seeding.
+        """
+        key = (id(graph), id(initial_op), id(seeding))
+        if key not in self._handles:
+            indptr, indices = graph_to_csr(graph)
+            if seeding is None:
+                seeding = np.arange(len(initial_op))
+            handles = (self.share(indptr), self.share(indices),
+                       self.share(np.asarray(initial_op, dtype=float)),
+                       self.share(np.asarray(seeding)))
+            # Keep the objects alive so that their ids are not reused
+            self._handles[key] = (handles, (graph, initial_op, seeding))
+
+        return self._handles[key][0]
+
+    def remove_topology(self, graph, initial_op, seeding=None):
+        """Free the shared arrays of a graph, if they were shared."""
+        shared = self._handles.pop((id(graph), id(initial_op), id(seeding)),
+                                   None)
+        if shared is None:
+            return
+        for handle in shared[0]:
+            self.release(handle)
+
+    def run_hk_model_mc(self, mc, initial_op, graph, threshold_bc,
+                        seeding=None, simulation_steps=100000, tolerance=None,
+                        window=None, seed=0):
+        """Run ``mc`` replicas of ``hk_model`` in the workers, each one with
+        its own random stream derived from ``seed``.
+
+        Returns
+        -------
+        tuple
+            A tuple with the following elements:
+
+            list[np.ndarray]
+                Final opinions of each replica.
+            list[int]
+                Number of simulated steps of each replica.
+        """
+        topology = self.add_topology(graph, initial_op, seeding)
+        threshold = self.share(np.asarray(threshold_bc, dtype=float))
+
+        args = [(topology, threshold, simulation_steps, replica_seed,
+                 tolerance, window) for replica_seed in spawn_seeds(seed, mc)]
+        try:
+            results = self._pool.starmap(_hk_task, args)
+        finally:
+            self.release(threshold)
+
+        return [result[0] for result in results], \
+            [result[1] for result in results]
+
+    def run_hk_model_sweep(self, simulations, mc, simulation_steps=100000,
+                           tolerance=None, window=None, callback=None):
+        """Run ``mc`` replicas of ``hk_model`` for every threshold config of
+        several topologies as a single queue of jobs, so that every worker is
+        kept busy until the whole sweep ends.
+
+        Parameters
+        ----------
+        simulations : list[tuple]
+            Graph, initial opinions, list of threshold configs and list with
+            the seed of each config, for every topology.
+        mc : int
+            Number of Monte Carlo replicas of each config.
+        simulation_steps : int
+            Number of simulation steps.
+        tolerance : float
+            Tolerance of the stopping rule of ``hk_model``.
+        window : int
+            Number of steps of the stopping rule of ``hk_model``.
+        callback : callable
+            Function called with the topology index, the config index and the
+            results of a config as soon as all its replicas finish. The
+            results passed to the callback are not kept.
+
+        Returns
+        -------
+        list[list[tuple]]
+            Final opinions and number of simulated steps of the replicas of
+            each config of each topology, as returned by ``run_hk_model_mc``
+            with the seed of the config, or None for the configs passed to
+            the callback.
+        """
+        jobs = []
+        costs = []
+        shared_topologies = []
+        thresholds = []
+        results = []
+        pending = []
+
+        try:
+            for s, (graph, initial_op, threshold_list, seeds) in \
+                    enumerate(simulations):
+                if (id(graph), id(initial_op), id(None)) not in self._handles:
+                    shared_topologies.append((graph, initial_op))
+                topology = self.add_topology(graph, initial_op)
+
+                # Estimated runtime of a replica: each step scans the
+                # neighbors of an agent, so it grows with the mean degree and
+                # not with the number of nodes
+                cost = simulation_steps * (1 + 2 * graph.number_of_edges() /
+                                           max(graph.number_of_nodes(), 1))
+
+                for c, (threshold_bc, seed) in enumerate(zip(threshold_list,
+                                                             seeds)):
+                    threshold = self.share(np.asarray(threshold_bc,
+                                                      dtype=float))
+                    thresholds.append(threshold)
+                    for r, replica_seed in enumerate(spawn_seeds(seed, mc)):
+                        jobs.append(((s, c, r), (topology, threshold,
+                                                 simulation_steps,
+                                                 replica_seed, tolerance,
+                                                 window)))
+                        costs.append(cost)
+                results.append([[None] * mc for _ in threshold_list])
+                pending.append([mc] * len(threshold_list))
+
+            # Jobs with the longest estimated runtime first, so that the
+            # short ones fill the gaps at the end of the sweep
+            order = sorted(range(len(jobs)), key=lambda job: -costs[job])
+            for (s, c, r), result in self._pool.imap_unordered(
+                    _sweep_task, [jobs[job] for job in order]):
+                results[s][c][r] = result
+                pending[s][c] -= 1
+                if callback is not None and not pending[s][c]:
+                    callback(s, c, _config_results(results[s][c]))
+                    results[s][c] = None
+        finally:
+            for threshold in thresholds:
+                self.release(threshold)
+            for graph, initial_op in shared_topologies:
+                self.remove_topology(graph, initial_op)
+
+        return [[_config_results(config) if config is not None else None
+                 for config in topology] for topology in results]
+
+
+def _config_results(results):
+    """Split the (final opinions, steps) of the replicas of a config."""
+    return [result[0] for result in results], \
+        [result[1] for result in results]
+
+
+def _attach(handle):
+    """Get a view of a shared array, attaching to it the first time."""
+    name, shape, dtype = handle
+    if name not in _attached:
+        block = SharedMemory(name=name)
+        _attached[name] = (block, np.ndarray(shape, dtype=dtype,
+                                             buffer=block.buf))
+    return _attached[name][1]
+
+
+def _detach(handle):
+    """Stop using a shared array in this worker."""
+    block, array = _attached.pop(handle[0])
+    del array
+    block.close()
+
+
+def _hk_task(topology, threshold, simulation_steps, seed, tolerance, window):
+    """Simulate one HK replica on a shared topology."""
+    indptr_handle, indices_handle, opinions_handle, seeding_handle = topology
+
+    if indices_handle[0] not in _neighbors:
+        # Forget the topologies that are no longer being simulated
+        while len(_neighbors) >= _max_topologies:
+            old_topology = _neighbors.pop(next(iter(_neighbors)))[0]
+            for handle in old_topology:
+                _detach(handle)
+
+        indptr = _attach(indptr_handle)
+        indices = _attach(indices_handle)
+        neighbors = [indices[indptr[node]:indptr[node + 1]].tolist() for node
+                     in range(len(indptr) - 1)]
+        _neighbors[indices_handle[0]] = (topology, neighbors)
+
+    neighbors = _neighbors[indices_handle[0]][1]
+    initial_op = _attach(opinions_handle)
+    seeding = _attach(seeding_handle).tolist()
+
+    # Thresholds change with every config, so they are not kept attached
+    threshold_bc = np.array(_attach(threshold))
+    _detach(threshold)
+
+    _, final_opinions, steps = _hk_steps(initial_op, neighbors, seeding,
+                                         simulation_steps, threshold_bc, seed,
+                                         tolerance, window)
+
+    return final_opinions, steps
+
+
+def _sweep_task(job):
+    """Simulate one HK replica of a sweep, keeping the position of the job."""
+    key, args = job
+    return key, _hk_task(*args)
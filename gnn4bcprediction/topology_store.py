@@ -0,0 +1,200 @@
+import json
+import os
+
+import numpy as np
+
+
+class Topology:
+    """Graph with nodes labelled 0..n-1, stored as the CSR arrays of its
+    adjacency together with an array for each node attribute.
+
+    It can be used instead of a networkx graph by the simulators, and its
+    arrays can be memory-mapped from a topology store.
+
+    Parameters
+    ----------
+    indptr : np.ndarray
+        Index of the first neighbor of each node in ``indices``.
+    indices : np.ndarray
+        Neighbors of each node, with both endpoints of every edge.
+    node_attributes : dict[str, np.ndarray]
+        Value of each node attribute for every node.
+    graph : dict
+        Graph attributes, as ``nx.Graph.graph``.
+    """
+
+    def __init__(self, indptr, indices, node_attributes=None, graph=None):
+        self.indptr = indptr
+        self.indices = indices
+        self.node_attributes = node_attributes if node_attributes is not None \
+            else {}
+        self.graph = graph if graph is not None else {}
+
+    def number_of_nodes(self):
+        return len(self.indptr) - 1
+
+    def number_of_edges(self):
+        # Self-loops are the only edges with a single endpoint in indices
+        sources = np.repeat(np.arange(self.number_of_nodes()),
+                            np.diff(self.indptr))
+        return (len(self.indices) +
+                int(np.count_nonzero(self.indices == sources))) // 2
+
+    def number_of_components(self):
+        return self._component_labels()[0]
+
+    def components(self):
+        """Split the topology in connected components, keeping the order of
+        the nodes and of their neighbors.
+
+        Returns
+        -------
+        list[tuple]
+            Nodes of each component and the component as a Topology.
+        """
+        n = self.number_of_nodes()
+        indptr = np.asarray(self.indptr)
+        indices = np.asarray(self.indices)
+        degrees = np.diff(indptr)
+        sources = np.repeat(np.arange(n), degrees)
+
+        num_components, labels = self._component_labels()
+
+        # Nodes and edges of each component, in the order of the topology
+        node_splits = np.cumsum(np.bincount(labels, minlength=num_components))
+        edge_splits = np.cumsum(np.bincount(labels[sources],
+                                            minlength=num_components))
+        component_nodes = np.split(np.argsort(labels, kind='stable'),
+                                   node_splits[:-1])
+        component_edges = np.split(np.argsort(labels[sources], kind='stable'),
+                                   edge_splits[:-1])
+
+        # Position of each node in its component
+        positions = np.empty(n, dtype=np.int64)
+        for nodes in component_nodes:
+            positions[nodes] = np.arange(len(nodes))
+
+        components = []
+        for nodes, edges in zip(component_nodes, component_edges):
+            component_indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+            np.cumsum(degrees[nodes], out=component_indptr[1:])
+            components.append((nodes, Topology(
+                component_indptr, positions[indices[edges]],
+                {key: np.asarray(values)[nodes] for key, values in
+                 self.node_attributes.items()}, dict(self.graph))))
+
+        return components
+
+    def _component_labels(self):
+        """Number of connected components and component of each node."""
+        from scipy.sparse import csr_matrix
+        from scipy.sparse.csgraph import connected_components
+
+        n = self.number_of_nodes()
+        return connected_components(
+            csr_matrix((np.ones(len(self.indices)), np.asarray(self.indices),
+                        np.asarray(self.indptr)), shape=(n, n)),
+            directed=False)
+
+    def to_networkx(self):
+        """Build the networkx graph of the topology."""
+        import networkx as nx
+
+        G = nx.Graph()
+        G.graph.update(self.graph)
+
+        node_attributes = {key: np.asarray(values).tolist() for key, values in
+                           self.node_attributes.items()}
+        G.add_nodes_from(
+            (node, {key: values[node] for key, values in
+                    node_attributes.items()})
+            for node in range(self.number_of_nodes()))
+
+        sources = np.repeat(np.arange(self.number_of_nodes()),
+                            np.diff(self.indptr))
+        G.add_edges_from(zip(sources.tolist(),
+                             np.asarray(self.indices).tolist()))
+
+        return G
+
+
+def from_networkx(graph):
+    """Build the Topology of a networkx graph with nodes labelled 0..n-1."""
+    from gnn4bcprediction.bc_models import graph_to_csr
+
+    indptr, indices = graph_to_csr(graph)
+    n = graph.number_of_nodes()
+
+    node_attributes = {}
+    if n > 0:
+        for key in graph.nodes[0].keys():
+            node_attributes[str(key)] = np.asarray(
+                [graph.nodes[node][key] for node in range(n)])
+
+    return Topology(indptr, indices, node_attributes, dict(graph.graph))
+
+
+def node_attribute(graph, key):
+    """Value of a node attribute for every node of a networkx graph or a
+    Topology."""
+    if isinstance(graph, Topology):
+        return graph.node_attributes[key]
+    return [graph.nodes[node][key] for node in graph.nodes()]
+
+
+def save_topology(graph, path):
+    """Save a networkx graph or a Topology in a topology store directory,
+    with a ``.npy`` file for each array and the rest in ``meta.json``."""
+    topology = graph if isinstance(graph, Topology) else from_networkx(graph)
+    os.makedirs(path, exist_ok=True)
+
+    np.save(os.path.join(path, 'indptr.npy'), topology.indptr)
+    np.save(os.path.join(path, 'indices.npy'), topology.indices)
+
+    # Attributes that can't be stored as plain arrays are kept in JSON
+    meta = {'graph': topology.graph, 'node_attributes': [],
+            'json_node_attributes': {}}
+    for key, values in topology.node_attributes.items():
+        values = np.asarray(values)
+        if values.dtype == object:
+            meta['json_node_attributes'][key] = values.tolist()
+        else:
+            np.save(os.path.join(path, f'node_{key}.npy'), values)
+            meta['node_attributes'].append(key)
+
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+def load_topology(path, mmap_mode='r'):
+    """Load a Topology from a topology store directory, memory-mapping its
+    arrays unless ``mmap_mode`` is None."""
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+
+    node_attributes = {
+        key: np.load(os.path.join(path, f'node_{key}.npy'),
+                     mmap_mode=mmap_mode)
+        for key in meta['node_attributes']}
+    for key, values in meta['json_node_attributes'].items():
+        node_attributes[key] = np.array(values, dtype=object)
+
+    return Topology(np.load(os.path.join(path, 'indptr.npy'),
+                            mmap_mode=mmap_mode),
+                    np.load(os.path.join(path, 'indices.npy'),
+                            mmap_mode=mmap_mode),
+                    node_attributes, meta['graph'])
+
+
+def convert_topology(source, path):
+    """Convert a GML file or a node-link JSON file to a topology store
+    directory."""
+    import networkx as nx
+
+    if source.endswith('.json'):
+        with open(source) as f:
+            graph = nx.node_link_graph(json.load(f))
+    else:
+        graph = nx.read_gml(source, label='id')
+
+    save_topology(nx.convert_node_labels_to_integers(graph), path)
@@ -0,0 +1,173 @@
+import math
+import os
+from multiprocessing import Pool
+
+import torch
+from torch_geometric.loader import DataLoader
+
+from gnn4bcprediction.ml_scheme import train_model, test_torch, \
+    feature_dtypes
+from gnn4bcprediction.nn_models import MLP, GCN, GATv2, GraphSAGE
+from gnn4bcprediction.pyg_dataset import load_dataset
+
+layers = {'mlp': MLP, 'gcn': GCN, 'sage': GraphSAGE, 'gatv2': GATv2}
+
+# Train and validation splits of each dataset, loaded once by each worker
+_datasets = {}
+
+
+def config_name(config):
+    """Name of the files of a config, as in train_model.py."""
+    scenario = config['dataset_name'].split('_')[-1]
+    return f'{config["layer_name"]}_{scenario}_{config["lr"]}_' \
+           f'{config["num_layers"]}_{config["hidden_dim"]}_' \
+           f'b{config["batch_size"]}'
+
+
+def successive_halving(configs, max_epochs=10000, eta=3, num_rungs=3,
+                       processes=None, threads_per_worker=None,
+                       datasets_folder='data/datasets/synthetic/',
+                       device='cpu', **train_options):
+    """Train a grid of configs in a pool of workers, pruning the configs
+    with the worst validation loss after each rung of epochs.
+
+    Every config starts with ``max_epochs / eta ** (num_rungs - 1)`` epochs,
+    and after each rung only the best ``1 / eta`` of the configs with the
+    same dataset and layer (those compared by test_hyperparameter_tuning.py)
+    are trained further, with ``eta`` times more epochs. Training is resumed
+    from the checkpoint of the previous rung. Each config writes its model
+    and loss curve in the same files as train_model.py.
+
+    Parameters
+    ----------
+    configs : list[dict]
+        Configs with the dataset_name, layer_name, lr, num_layers,
+        hidden_dim and batch_size arguments of train_model.py.
+    max_epochs : int
+        Epochs of the configs that reach the last rung.
+    eta : int
+        Fraction of configs kept and growth of the epochs at each rung.
+    num_rungs : int
+        Number of rungs.
+    processes : int
+        Number of workers.
+    threads_per_worker : int
+        Number of torch threads of each worker, so that the workers do not
+        compete for the cores (the cores divided among the workers by
+        default).
+    datasets_folder : str
+        Folder of the datasets.
+    device : str
+        Device of the models.
+    train_options : dict
+        Options of ``train_model`` (batching, eval_every, precision, ...).
+        The node features are loaded in the type of the precision.
+
+    Returns
+    -------
+    list[dict]
+        Each config with the epochs it was trained and the validation loss
+        of its best model.
+    """
+    if processes is None:
+        processes = os.cpu_count()
+    if threads_per_worker is None:
+        threads_per_worker = max(1, os.cpu_count() // processes)
+
+    dataset_names = sorted({config['dataset_name'] for config in configs})
+    rung_epochs = [math.ceil(max_epochs / eta ** (num_rungs - 1 - rung)) for
+                   rung in range(num_rungs)]
+
+    results = [dict(config, epochs=0, mse_val=float('inf')) for config in
+               configs]
+    alive = list(range(len(configs)))
+
+    features_dtype = feature_dtypes[train_options.get('precision',
+                                                      'float32')]
+    with Pool(processes, initializer=_init_worker,
+              initargs=(dataset_names, datasets_folder, device,
+                        threads_per_worker, features_dtype)) as pool:
+        for rung, epochs in enumerate(rung_epochs):
+            print(f'Rung {rung}: {len(alive)} configs, {epochs} epochs')
+            last_rung = rung == num_rungs - 1
+
+            tasks = [(i, configs[i], epochs, not last_rung, device,
+                      train_options) for i in alive]
+            for i, mse_val in pool.imap_unordered(_train_task, tasks):
+                results[i]['epochs'] = epochs
+                results[i]['mse_val'] = mse_val
+
+            if last_rung:
+                break
+
+            # Keep the best configs of each dataset and layer
+            groups = {}
+            for i in alive:
+                groups.setdefault((configs[i]['dataset_name'],
+                                   configs[i]['layer_name']), []).append(i)
+            alive = []
+            for group in groups.values():
+                group.sort(key=lambda i: results[i]['mse_val'])
+                alive.extend(group[:math.ceil(len(group) / eta)])
+
+    # The pruned configs are not resumed by later sweeps
+    for config in configs:
+        checkpoint_file = f'models/checkpoints/{config["dataset_name"]}/' \
+                          f'{config["layer_name"]}/{config_name(config)}.ckpt'
+        if os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+
+    return results
+
+
+def _init_worker(dataset_names, datasets_folder, device, num_threads,
+                 features_dtype=None):
+    torch.set_num_threads(num_threads)
+    for dataset_name in dataset_names:
+        dataset_root = f'{datasets_folder}{dataset_name}_0.2-0.2_'
+        _datasets[dataset_name] = (
+            load_dataset(f'{dataset_root}train', device,
+                         features_dtype=features_dtype),
+            load_dataset(f'{dataset_root}val', device,
+                         features_dtype=features_dtype))
+
+
+def _train_task(task):
+    """Train a config up to a number of epochs, as train_model.py does."""
+    i, config, epochs, keep_checkpoint, device, train_options = task
+    dataset_name = config['dataset_name']
+    layer_name = config['layer_name']
+    train_dataset, val_dataset = _datasets[dataset_name]
+    is_gnn = layer_name in ['gcn', 'sage', 'gatv2']
+
+    train_data_loader = DataLoader(train_dataset,
+                                   batch_size=config['batch_size'],
+                                   shuffle=True)
+    val_data_loader = DataLoader(val_dataset, batch_size=config['batch_size'],
+                                 shuffle=True)
+
+    model = layers[layer_name](
+        input_dim=train_dataset[0].num_features,
+        hidden_dim=config['hidden_dim'], output_dim=1,
+        num_hidden_layers=config['num_layers'] - 2).to(device)
+
+    config_file = f'{dataset_name}/{layer_name}/{config_name(config)}'
+
+    torch.manual_seed(0)
+    model.reset_parameters()
+
+    eval_every = train_options.get('eval_every', 1)
+    best_model = train_model(
+        original_model=model, train_data_loader=train_data_loader,
+        val_data_loader=val_data_loader, optimizer=torch.optim.Adam,
+        loss_fn=torch.nn.MSELoss(), lr=config['lr'], epochs=epochs,
+        early_stopping_steps=1000 // eval_every, is_gnn=is_gnn,
+        results_file=f'data/tuning_results/{config_file}.png',
+        model_file=f'models/tuning/{config_file}.pt',
+        checkpoint_file=f'models/checkpoints/{config_file}.ckpt',
+        keep_checkpoint=keep_checkpoint, **train_options)
+
+    # Validation loss of the best model, as in test_hyperparameter_tuning.py
+    val_data_loader = DataLoader(val_dataset, batch_size=1, shuffle=False)
+    return i, test_torch(best_model, val_data_loader, torch.nn.MSELoss(),
+                         is_gnn, train_options.get('precision', 'float32'))
@@ -0,0 +1,95 @@
+import json
+import os
+import sys
+import time
+
+import torch
+from torch_geometric.loader import DataLoader
+
+from gnn4bcprediction.nn_models import GCN, GATv2, GraphSAGE, MLP, \
+    compile_model
+from gnn4bcprediction.pyg_dataset import load_dataset
+
+# Usage: benchmark_compiled_inference.py [<dataset_split>]
+dataset_path = sys.argv[1] if len(sys.argv) > 1 else \
+    'data/datasets/synthetic/synthetic_1000000_10_20_0.5_hom_0.2-0.2_test'
+results_file = 'data/benchmarks/compiled_inference.json'
+
+torch.set_default_tensor_type(torch.FloatTensor)
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+layers = {'mlp': MLP, 'gcn': GCN, 'sage': GraphSAGE, 'gatv2': GATv2}
+num_layers = 4
+hidden_dim = 32
+batch_sizes = [1, 8]
+repetitions = 5
+
+
+@torch.no_grad()
+def predict(model, data_loader, is_gnn):
+    return [model(batch.x, batch.edge_index) if is_gnn else model(batch.x)
+            for batch in data_loader]
+
+
+def throughput(model, data_loader, is_gnn):
+    """Best time of a pass over the dataset, after a warm-up pass that also
+    compiles the model."""
+    predictions = predict(model, data_loader, is_gnn)
+    times = []
+    for _ in range(repetitions):
+        start = time.perf_counter()
+        predict(model, data_loader, is_gnn)
+        times.append(time.perf_counter() - start)
+    return min(times), predictions
+
+
+## 1. Eager and compiled throughput ###########################################
+
+dataset = load_dataset(dataset_path, device)
+num_nodes = sum(data.num_nodes for data in dataset)
+records = []
+
+for layer_name, layer in layers.items():
+    is_gnn = layer_name != 'mlp'
+    for batch_size in batch_sizes:
+        data_loader = DataLoader(dataset, batch_size=batch_size,
+                                 shuffle=False)
+
+        torch.manual_seed(0)
+        model = layer(2, hidden_dim, 1, num_layers - 2).to(device)
+        model.eval()
+        eager_time, eager_predictions = throughput(model, data_loader,
+                                                   is_gnn)
+
+        start = time.perf_counter()
+        compile_model(model)
+        compiled_time, compiled_predictions = throughput(model, data_loader,
+                                                         is_gnn)
+        warmup_time = time.perf_counter() - start - repetitions * \
+            compiled_time
+
+        max_error = max(float(torch.max(torch.abs(eager - compiled))) for
+                        eager, compiled in zip(eager_predictions,
+                                               compiled_predictions))
+        records.append({'layer': layer_name, 'batch_size': batch_size,
+                        'eager_time': eager_time,
+                        'compiled_time': compiled_time,
+                        'compile_time': warmup_time,
+                        'eager_nodes_per_second': num_nodes / eager_time,
+                        'compiled_nodes_per_second': num_nodes / compiled_time,
+                        'max_error': max_error})
+        print(f'{layer_name} (batch size {batch_size}): '
+              f'eager {num_nodes / eager_time:.0f} nodes/s, '
+              f'compiled {num_nodes / compiled_time:.0f} nodes/s '
+              f'({eager_time / compiled_time:.2f}x), '
+              f'max error {max_error:.1e}')
+
+## 2. Save the results ########################################################
+
+os.makedirs(os.path.dirname(results_file), exist_ok=True)
+with open(results_file, 'w') as f:
+    json.dump({'dataset': dataset_path, 'graphs': len(dataset),
+               'nodes': num_nodes, 'device': device,
+               'torch': torch.__version__, 'num_layers': num_layers,
+               'hidden_dim': hidden_dim, 'records': records}, f, indent=2)
+print(f'Results saved in {results_file}')
@@ -0,0 +1,236 @@
+import ctypes
+import gc
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import networkx as nx
+import numpy as np
+import torch
+from sklearn.model_selection import train_test_split
+from torch_geometric.transforms import RandomNodeSplit
+from torch_geometric.utils import from_networkx as pyg_from_networkx
+
+from gnn4bcprediction.bc_models import generate_random_uniform_values, \
+    run_hk_model_ensemble
+from gnn4bcprediction.dataset_generation import generate_threshold_configs, \
+    build_multiple_attribute_graph, build_topology_data, build_attribute_data
+from gnn4bcprediction.pyg_dataset import CollatedDataset, collated_path
+from gnn4bcprediction.topology_store import from_networkx, save_topology, \
+    load_topology
+
+# Usage: benchmark_dataset_generation.py [<baseline.json>]
+baseline_file = sys.argv[1] if len(sys.argv) > 1 else None
+results_file = 'data/benchmarks/dataset_generation.json'
+
+seed = 37
+sizes = [1000, 10000, 100000]
+families = {
+    'erdos': lambda n: nx.fast_gnp_random_graph(n, 8 / n, seed=seed),
+    'newman': lambda n: nx.newman_watts_strogatz_graph(n, 6, 0.3, seed=seed),
+    'barabasi': lambda n: nx.barabasi_albert_graph(n, 4, seed=seed)}
+num_communities = 10
+simulation_steps = 100000
+mc = 4
+num_configs = 5
+max_threshold = 0.5
+per_val = 0.2
+per_test = 0.2
+# Converting through networkx is too slow for the largest topologies
+max_nx_nodes = 10000
+# A stage regresses if it takes this factor longer than in the baseline (and
+# at least min_regression seconds longer)
+max_slowdown = 1.5
+min_regression = 0.05
+
+
+def memory_status(key):
+    """Value of a memory field of /proc/self/status in bytes, or None where
+    it is not available (outside Linux)."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(f'{key}:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+
+
+def reset_peak_memory():
+    """Return the memory freed by previous stages to the system, so that a
+    stage cannot reuse it without growing the resident set size, and reset
+    the peak resident set size (VmHWM) to the current one."""
+    gc.collect()
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def run_stage(stages, name, function, *args):
+    """Time a stage and measure the growth of the peak resident set size of
+    the process while it runs.
+
+    Unlike tracemalloc, the resident set size also counts the memory of
+    numpy arrays and torch tensors."""
+    start_memory = memory_status('VmRSS') if reset_peak_memory() else None
+
+    start = time.perf_counter()
+    output = function(*args)
+    elapsed = time.perf_counter() - start
+
+    peak = None
+    if start_memory is not None:
+        peak = memory_status('VmHWM') - start_memory
+
+    stages[name] = {'time': elapsed, 'peak_memory': peak}
+    memory = 'n/a' if peak is None else f'{peak / 2 ** 20:.1f} MiB'
+    print(f'  {name}: {elapsed:.3f}s, {memory}')
+
+    return output
+
+
+def generate_opinions_and_thresholds(topology):
+    initial_opinions = generate_random_uniform_values(
+        topology.number_of_nodes(), generator=np.random.default_rng(seed))
+    hom_configs = generate_threshold_configs(topology, num_configs,
+                                             max_threshold, False, seed)
+    com_configs = generate_threshold_configs(topology, num_configs,
+                                             max_threshold, True, seed)
+    return initial_opinions, hom_configs, com_configs
+
+
+def build_dataset(topology, initial_opinions, threshold_list,
+                  mean_final_opinions):
+    topology_data = build_topology_data(topology)
+    return [data for threshold_bc, mean in
+            zip(threshold_list, mean_final_opinions) for data in
+            build_attribute_data(topology_data, initial_opinions, mean,
+                                 threshold_bc, simulation_steps, mc)]
+
+
+def split_dataset(data_list):
+    torch.manual_seed(seed)
+    data_list = [RandomNodeSplit(num_val=per_val, num_test=per_test)(data)
+                 for data in data_list]
+    temp_data, test_data = train_test_split(data_list, test_size=per_test,
+                                            random_state=seed)
+    train_data, val_data = train_test_split(temp_data, test_size=per_val,
+                                            random_state=seed)
+    return {'train': train_data, 'val': val_data, 'test': test_data}
+
+
+def save_dataset(splits, path):
+    for split, data_list in splits.items():
+        CollatedDataset.save(data_list, collated_path(f'{path}_{split}'))
+    return sum(os.path.getsize(collated_path(f'{path}_{split}')) for split in
+               splits)
+
+
+## 1. Benchmark every stage for each family and size ##########################
+
+records = []
+
+with tempfile.TemporaryDirectory() as temp_folder:
+    for family, generate_graph in families.items():
+        for n in sizes:
+            print(f'{family} - {n} nodes')
+            stages = {}
+
+            # Topologies as stored by convert_topologies.py, with contiguous
+            # communities of the same size
+            graph = generate_graph(n)
+            topology = from_networkx(graph)
+            topology.node_attributes['community'] = \
+                np.arange(n) * num_communities // n
+            store_path = f'{temp_folder}/{family}_{n}'
+            save_topology(topology, store_path)
+
+            topology = run_stage(stages, 'topology_load', load_topology,
+                                 store_path)
+            initial_opinions, (threshold_list, simulation_seeds), _ = \
+                run_stage(stages, 'opinion_threshold_generation',
+                          generate_opinions_and_thresholds, topology)
+            final_opinions, _ = run_stage(
+                stages, 'mc_simulation', lambda: run_hk_model_ensemble(
+                    mc=mc, initial_op=initial_opinions, graph=topology,
+                    threshold_bc=threshold_list,
+                    simulation_steps=simulation_steps,
+                    seed=simulation_seeds))
+            mean_final_opinions = run_stage(
+                stages, 'aggregation', lambda: list(np.mean(final_opinions,
+                                                            axis=0)))
+
+            if n <= max_nx_nodes:
+                graph = run_stage(
+                    stages, 'nx_attribute_writing',
+                    build_multiple_attribute_graph, topology,
+                    initial_opinions, threshold_list, mean_final_opinions,
+                    simulation_steps, mc)
+                run_stage(stages, 'pyg_conversion_nx', lambda: [
+                    pyg_from_networkx(graph.subgraph(c).copy(),
+                                      group_node_attrs=['initial_opinion',
+                                                        'final_opinion'])
+                    for c in nx.connected_components(graph)])
+
+            data_list = run_stage(stages, 'pyg_conversion', build_dataset,
+                                  topology, initial_opinions, threshold_list,
+                                  mean_final_opinions)
+            splits = run_stage(stages, 'splitting', split_dataset, data_list)
+            dataset_size = run_stage(stages, 'serialization', save_dataset,
+                                     splits, f'{temp_folder}/{family}_{n}')
+
+            records.append({'family': family, 'nodes': n,
+                            'edges': topology.number_of_edges(),
+                            'dataset_bytes': dataset_size,
+                            'stages': stages})
+
+## 2. Save the results ########################################################
+
+results = {'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+           'python': platform.python_version(), 'numpy': np.__version__,
+           'torch': torch.__version__, 'networkx': nx.__version__,
+           'parameters': {'seed': seed, 'simulation_steps': simulation_steps,
+                          'mc': mc, 'num_configs': num_configs,
+                          'num_communities': num_communities},
+           'records': records}
+
+os.makedirs(os.path.dirname(results_file), exist_ok=True)
+with open(results_file, 'w') as f:
+    json.dump(results, f, indent=2)
+print(f'Results saved in {results_file}')
+
+## 3. Compare with a baseline #################################################
+
+failed = False
+
+if baseline_file is not None:
+    with open(baseline_file) as f:
+        baseline = {(record['family'], record['nodes']): record['stages']
+                    for record in json.load(f)['records']}
+
+    for record in records:
+        baseline_stages = baseline.get((record['family'], record['nodes']),
+                                       {})
+        for stage, result in record['stages'].items():
+            if stage not in baseline_stages:
+                continue
+            baseline_time = baseline_stages[stage]['time']
+            if result['time'] > max_slowdown * baseline_time and \
+                    result['time'] - baseline_time > min_regression:
+                print(f'ERROR: {stage} of {record["family"]} - '
+                      f'{record["nodes"]} nodes takes {result["time"]:.3f}s '
+                      f'(baseline {baseline_time:.3f}s)!')
+                failed = True
+
+sys.exit(1 if failed else 0)
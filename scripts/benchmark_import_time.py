@@ -0,0 +1,49 @@
+import json
+import subprocess
+import sys
+
+# Modules of the simulation-only path, with the maximum import time (seconds)
+modules = {'gnn4bcprediction.bc_models': 1.0,
+           'gnn4bcprediction.simulation_pool': 1.0,
+           'gnn4bcprediction.dataset_generation': 2.0}
+# Backends that must not be loaded by the simulation-only path
+heavy_modules = ['torch', 'torch_geometric', 'sklearn', 'matplotlib',
+                 'scipy']
+repetitions = 5
+
+# Each import is timed in a fresh interpreter
+code = '''
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'time': elapsed,
+                  'loaded': [m for m in {heavy} if m in sys.modules]}}))
+'''
+
+## 1. Import times ############################################################
+
+failed = False
+
+for module, max_time in modules.items():
+    times = []
+    for _ in range(repetitions):
+        output = subprocess.run(
+            [sys.executable, '-c', code.format(module=module,
+                                               heavy=heavy_modules)],
+            capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.splitlines()[-1])
+        times.append(result['time'])
+
+    best = min(times)
+    print(f'{module}: {best:.3f}s (max {max_time:.1f}s)')
+
+    # Regression checks
+    if best > max_time:
+        print(f'ERROR: {module} takes too long to import!')
+        failed = True
+    if result['loaded']:
+        print(f'ERROR: {module} loads {", ".join(result["loaded"])}!')
+        failed = True
+
+sys.exit(1 if failed else 0)
@@ -0,0 +1,25 @@
+import os
+
+from gnn4bcprediction.topology_store import convert_topology
+
+topologies_folder = 'data/topologies/'
+graphs_folder = 'data/nx_graphs/'
+store_folder = 'data/topology_store/'
+
+## 1. GML topologies ##########################################################
+
+for top_type in ['synthetic', 'real']:
+    for file in os.listdir(f'{topologies_folder}{top_type}'):
+        if file.endswith('.gml'):
+            print(f'Converting {file}')
+            convert_topology(f'{topologies_folder}{top_type}/{file}',
+                             f'{store_folder}{top_type}/{file[:-4]}')
+
+## 2. Node-link JSON graphs with the simulation results #######################
+
+if os.path.isdir(graphs_folder):
+    for file in os.listdir(graphs_folder):
+        if file.endswith('.json'):
+            print(f'Converting {file}')
+            convert_topology(f'{graphs_folder}{file}',
+                             f'{graphs_folder}{file[:-5]}')
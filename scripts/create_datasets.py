@@ -1,21 +1,31 @@
+import argparse
 import os
 
-import networkx as nx
-
 from gnn4bcprediction.dataset_generation import create_datasets
+from gnn4bcprediction.simulation_cache import SimulationCache
+from gnn4bcprediction.topology_store import load_topology
 
 
 def load_topologies(folder_path):
+    # Topologies converted by convert_topologies.py, memory-mapped
     topologies = []
     top_names = []
 
     for top_name in os.listdir(folder_path):
-        topologies.append(nx.read_gml(f'{folder_path}/{top_name}', label='id'))
-        top_names.append(top_name[:-4])
+        topologies.append(load_topology(f'{folder_path}/{top_name}'))
+        top_names.append(top_name)
 
     return topologies, top_names
 
 
+parser = argparse.ArgumentParser()
+# Simulate the replicas of every config in lockstep on one core (the
+# vectorized ensemble, the default), or schedule them one by one on a pool
+# of worker processes that share the topologies ('sweep'), which only pays
+# off with many cores
+parser.add_argument('--engine', choices=['ensemble', 'sweep'],
+                    default='ensemble')
+
 seed = 37
 simulation_steps = 1000000
 mc = 10
@@ -24,26 +34,37 @@ per_test = 0.2
 num_configs = 20
 max_threshold = 0.5
 
-## 1. Synthetic dataset #######################################################
+# Simulations already run are reused, e.g. to resume an interrupted run
+cache = SimulationCache('data/simulation_cache')
+
+# The sweep's workers may import this script, which only runs as main
+if __name__ == '__main__':
+    args = parser.parse_args()
+    ensemble = args.engine == 'ensemble'
+
+    ## 1. Synthetic dataset ###################################################
 
-syn_topologies, syn_names = load_topologies('data/topologies/synthetic')
+    syn_topologies, syn_names = load_topologies(
+        'data/topology_store/synthetic')
 
-for scenario in [False, True]:
-    create_datasets(topologies=syn_topologies, top_names=syn_names,
-                    dataset_name='synthetic', steps=simulation_steps, mc=mc,
-                    per_val=per_val, per_test=per_test,
-                    num_configs=num_configs, seed=seed,
-                    max_threshold=max_threshold, mix=True,
-                    communities=scenario, save_nx=False)
+    for scenario in [False, True]:
+        create_datasets(topologies=syn_topologies, top_names=syn_names,
+                        dataset_name='synthetic', steps=simulation_steps,
+                        mc=mc, per_val=per_val, per_test=per_test,
+                        num_configs=num_configs, seed=seed,
+                        max_threshold=max_threshold, mix=True,
+                        communities=scenario, save_nx=False,
+                        ensemble=ensemble, cache=cache, from_arrays=True)
 
-## 2. Real-world test graphs ##################################################
+    ## 2. Real-world test graphs ##############################################
 
-real_topologies, real_names = load_topologies('data/topologies/real')
+    real_topologies, real_names = load_topologies('data/topology_store/real')
 
-# First configuration: Homogeneous thresholds
-for scenario in [False, True]:
-    create_datasets(topologies=real_topologies, top_names=real_names,
-                    dataset_name='', steps=simulation_steps, mc=mc, per_val=0,
-                    per_test=0, num_configs=num_configs, seed=seed,
-                    max_threshold=max_threshold, mix=False,
-                    communities=scenario, save_nx=False)
+    # First configuration: Homogeneous thresholds
+    for scenario in [False, True]:
+        create_datasets(topologies=real_topologies, top_names=real_names,
+                        dataset_name='', steps=simulation_steps, mc=mc,
+                        per_val=0, per_test=0, num_configs=num_configs,
+                        seed=seed, max_threshold=max_threshold, mix=False,
+                        communities=scenario, save_nx=False,
+                        ensemble=ensemble, cache=cache, from_arrays=True)
@@ -1,10 +1,10 @@
-import json
 import os
 
-import networkx as nx
 from matplotlib import pyplot as plt
 
-from gnn4bcprediction.bc_models import plot_opinions, hk_model
+from gnn4bcprediction.bc_models import (plot_opinions, hk_model,
+                                        TrajectoryRecorder)
+from gnn4bcprediction.topology_store import load_topology
 
 graphs_folder = 'data/nx_graphs/'
 
@@ -23,25 +23,12 @@ for top_type in topologies.keys():
         for topology in topologies[top_type]:
             print(f'Processing {topology}')
 
-            with open(
-                    f'{graphs_folder}{topology}_1000000_10_20_0.5_{scenario}.json') as f:
-                data = json.load(f)
+            G = load_topology(
+                f'{graphs_folder}{topology}_1000000_10_20_0.5_{scenario}')
 
-            G = nx.node_link_graph(data)
-            graphs = [G.subgraph(c).copy() for c in nx.connected_components(G)]
-
-            for graph_id, graph in enumerate(graphs):
-                mapping = {n: i for i, n in enumerate(graph.nodes)}
-                graph = nx.relabel_nodes(graph, mapping)
-
-                initial_opinions = [graph.nodes[n]['initial_opinion'] for n in
-                                    graph.nodes]
-                thresholds = [graph.nodes[n]['threshold'] for n in graph.nodes]
-
-                data_plot, final_opinions_mc = hk_model(
-                    initial_op=initial_opinions, graph=graph,
-                    threshold_bc=thresholds,
-                    simulation_steps=graph.graph['simulation_steps'])
+            for graph_id, (_, graph) in enumerate(G.components()):
+                initial_opinions = graph.node_attributes['initial_opinion']
+                thresholds = graph.node_attributes['threshold']
 
                 if scenario == 'hom':
                     title = f'HK execution with homogeneous threshold {thresholds[0]:.2f}'
@@ -50,6 +37,17 @@ for top_type in topologies.keys():
                     title = f'HK execution with threshold by community ({graph_id})'
                     filename = f'{simul_output_folder}com_{topology}_{graph_id}.png'
 
+                # Record one every 10 steps, spilling to disk the trajectories
+                # that do not fit in memory
+                recorder = TrajectoryRecorder(
+                    stride=10, spill_path=filename.replace('.png', '.npy'))
+
+                data_plot, final_opinions_mc, steps = hk_model(
+                    initial_op=initial_opinions, graph=graph,
+                    threshold_bc=thresholds,
+                    simulation_steps=graph.graph['simulation_steps'],
+                    recorder=recorder)
+
                 plot_opinions(initial_opinions, data_plot, final_opinions_mc,
                               title, filename, graph.graph['simulation_steps'])
                 plt.clf()
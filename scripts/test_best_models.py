@@ -10,8 +10,11 @@ from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score, \
     mean_absolute_percentage_error
 from torch_geometric.loader import DataLoader
 
+from gnn4bcprediction.ml_scheme import autocast, feature_dtypes
 from gnn4bcprediction.nn_models import GCN, GATv2, GraphSAGE
-from gnn4bcprediction.nn_models import MLP
+from gnn4bcprediction.neighbor_sampling import NeighborSampledLoader
+from gnn4bcprediction.nn_models import MLP, compile_model
+from gnn4bcprediction.pyg_dataset import load_dataset, split_path
 
 ## 0. Set torch configurations ################################################
 
@@ -19,6 +22,17 @@ torch.set_default_tensor_type(torch.FloatTensor)
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
+# Evaluate the models compiled with torch.compile instead of eagerly
+compile_models = False
+# Evaluate the models in 'float32' or in 'bfloat16' autocast, with the node
+# features stored in that precision
+precision = 'float32'
+# Evaluate the models on subgraphs sampled around batches of seed nodes, with
+# this number of neighbors per layer (-1 for all), instead of on whole
+# graphs, e.g. for the largest real graphs
+sampled_num_neighbors = None
+seed_batch_size = 4096
+
 ## 1. Set paths and models/training configurations ############################
 models_best_folder = 'models/best/'
 datasets_folder = 'data/datasets/'
@@ -36,15 +50,20 @@ batch_results = {'hom': {}, 'com': {}}
 for dataset_name in os.listdir(datasets_folder):
     test_results_folder = f'{test_results_root}{dataset_name}/'
     os.makedirs(test_results_folder, exist_ok=True)
-    for dataset_scenario in os.listdir(f'{datasets_folder}{dataset_name}'):
-        split = dataset_scenario.split('_')[-1].split('.')[0]
+    # Splits saved in several shards or files are evaluated once
+    dataset_scenarios = sorted(
+        {split_path(file) for file in
+         os.listdir(f'{datasets_folder}{dataset_name}')})
+    for dataset_scenario in dataset_scenarios:
+        split = dataset_scenario.split('_')[-1]
         if split not in ['train', 'val']:
             scenario = 'hom' if 'hom' in dataset_scenario else 'com'
             batch_results[scenario][dataset_name] = {}
             print(f'Processing dataset {dataset_name} - {scenario}')
 
-            dataset = [data.to(device) for data in torch.load(
-                f'{datasets_folder}{dataset_name}/{dataset_scenario}')]
+            dataset = load_dataset(
+                f'{datasets_folder}{dataset_name}/{dataset_scenario}', device,
+                features_dtype=feature_dtypes[precision])
             data_loader = DataLoader(dataset, batch_size=1, shuffle=False)
 
             for model_file in os.listdir(models_best_folder):
@@ -62,6 +81,8 @@ for dataset_name in os.listdir(datasets_folder):
                     model.load_state_dict(
                         torch.load(f'{models_best_folder}{model_file}'))
                     model.eval()
+                    if compile_models:
+                        compile_model(model)
 
                     print(
                         f'*** Processing model {model_file}: {layer_name} - {lr} - {L} - {H} - {bs}')
@@ -69,13 +90,34 @@ for dataset_name in os.listdir(datasets_folder):
                     # Evaluate the model on every batch and node ##############
                     y_true = []
                     y_pred = []
-                    for batch in data_loader:
-                        edge_index = batch.edge_index if is_gnn else None
-                        y_true.append(
-                            batch.y.cpu().detach().numpy().reshape(-1))
-                        y_pred.append(model.forward(batch.x,
-                                                    edge_index).cpu().detach().numpy().reshape(
-                            -1))
+                    with autocast(precision, torch.device(device).type):
+                        if sampled_num_neighbors is None:
+                            for batch in data_loader:
+                                edge_index = batch.edge_index if is_gnn \
+                                    else None
+                                y_true.append(
+                                    batch.y.cpu().detach().numpy().reshape(-1))
+                                # Predictions in float32 in any precision
+                                y_pred.append(model(
+                                    batch.x, edge_index).float().cpu().detach(
+                                ).numpy().reshape(-1))
+                        else:
+                            sampled_loader = NeighborSampledLoader(
+                                dataset, [sampled_num_neighbors] * L if
+                                is_gnn else [], batch_size=seed_batch_size)
+                            # Predictions of the seed nodes, in the order of
+                            # the nodes of the dataset
+                            predictions = torch.cat([model(
+                                batch.x, batch.edge_index if is_gnn else None
+                            ).float().detach().reshape(-1)[:batch.batch_size]
+                                for batch in sampled_loader])
+                            # Split by graph, as the batches of the data loader
+                            graph_sizes = [dataset[i].num_nodes for i in
+                                           range(len(dataset))]
+                            y_true = [y.cpu().numpy() for y in
+                                      sampled_loader.y.split(graph_sizes)]
+                            y_pred = [y.cpu().numpy() for y in
+                                      predictions.split(graph_sizes)]
 
                     complete_y_true = np.concatenate(y_true)
                     complete_y_pred = np.concatenate(y_pred)
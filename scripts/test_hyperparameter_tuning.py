@@ -6,9 +6,10 @@ import pandas as pd
 import torch
 from torch_geometric.loader import DataLoader
 
-from gnn4bcprediction.ml_scheme import test_torch
+from gnn4bcprediction.ml_scheme import test_torch, feature_dtypes
 from gnn4bcprediction.nn_models import GCN, GATv2, GraphSAGE
-from gnn4bcprediction.nn_models import MLP
+from gnn4bcprediction.nn_models import MLP, compile_model
+from gnn4bcprediction.pyg_dataset import load_dataset
 
 ## 0. Set torch configurations ################################################
 
@@ -16,6 +17,12 @@ torch.set_default_tensor_type(torch.FloatTensor)
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
+# Evaluate the models compiled with torch.compile instead of eagerly
+compile_models = False
+# Evaluate the models in 'float32' or in 'bfloat16' autocast, with the node
+# features stored in that precision
+precision = 'float32'
+
 ## 1. Set paths and models/training configurations ############################
 models_tuning_folder = 'models/tuning/'
 models_best_folder = 'models/best/'
@@ -37,10 +44,12 @@ bs_list = [2, 4, 8]
 for scenario in scenarios:
     dataset_name = f'synthetic_1000000_10_20_0.5_{scenario}'
     # Datasets
-    train_dataset = [data.to(device) for data in torch.load(
-        f'{datasets_folder}{dataset_name}_0.2-0.2_train.pt')]
-    val_dataset = [data.to(device) for data in torch.load(
-        f'{datasets_folder}{dataset_name}_0.2-0.2_val.pt')]
+    train_dataset = load_dataset(
+        f'{datasets_folder}{dataset_name}_0.2-0.2_train', device,
+        features_dtype=feature_dtypes[precision])
+    val_dataset = load_dataset(
+        f'{datasets_folder}{dataset_name}_0.2-0.2_val', device,
+        features_dtype=feature_dtypes[precision])
 
     # Data loaders
     train_data_loader = DataLoader(train_dataset, batch_size=1, shuffle=False)
@@ -61,9 +70,13 @@ for scenario in scenarios:
             model = layers[layer_name](2, H, 1, L - 2).to(device)
             model.load_state_dict(torch.load(f'{models_root}{config}.pt'))
             model.eval()
+            if compile_models:
+                compile_model(model)
 
-            mse_train = test_torch(model, train_data_loader, criterion, is_gnn)
-            mse_val = test_torch(model, val_data_loader, criterion, is_gnn)
+            mse_train = test_torch(model, train_data_loader, criterion, is_gnn,
+                                   precision)
+            mse_val = test_torch(model, val_data_loader, criterion, is_gnn,
+                                 precision)
 
             results = pd.concat([results, pd.DataFrame(
                 {'scenario': scenario, 'layer': layer_name, 'lr': lr, 'L': L,
@@ -1,22 +1,62 @@
-import sys
+import argparse
 
 import torch
 from torch_geometric.loader import DataLoader
 
-from gnn4bcprediction.ml_scheme import train_model, test_torch
+from gnn4bcprediction.ml_scheme import train_model, train_models, test_torch, \
+    feature_dtypes
+from gnn4bcprediction.neighbor_sampling import NeighborSampledLoader
 from gnn4bcprediction.nn_models import MLP, GCN, GATv2, GraphSAGE
-
-try:
-    dataset_name = sys.argv[1]
-    layer_name = sys.argv[2]
-    lr = float(sys.argv[3])
-    num_layers = int(sys.argv[4])
-    hidden_dim = int(sys.argv[5])
-    batch_size = int(sys.argv[6])
-except IndexError:
-    print("{0} <dataset_name> <layer_name> <lr> <num_layers> "
-          "<hidden_dim> <batch_size>".format(sys.argv[0]))
-    sys.exit(1)
+from gnn4bcprediction.pyg_dataset import load_dataset
+
+parser = argparse.ArgumentParser()
+parser.add_argument('dataset_name')
+parser.add_argument('layer_name')
+# Several learning rates are trained at once by a vectorized model
+parser.add_argument('lr', type=float, nargs='+')
+parser.add_argument('num_layers', type=int)
+parser.add_argument('hidden_dim', type=int)
+parser.add_argument('batch_size', type=int)
+# Batches built by a DataLoader in every epoch ('loader'), collated once
+# ('cached') or a single disjoint-union batch per split ('full')
+parser.add_argument('--batching', choices=['loader', 'cached', 'full'],
+                    default='loader')
+# Epochs between evaluations
+parser.add_argument('--eval-every', type=int, default=1)
+# Report the train loss accumulated while training
+parser.add_argument('--fused-train-loss', action='store_true')
+# Train and evaluate the model compiled with torch.compile
+parser.add_argument('--compile', action='store_true')
+# Train and evaluate on subgraphs sampled around batches of seed nodes, with
+# a number of neighbors per layer (or one for every layer, -1 for all)
+parser.add_argument('--num-neighbors', type=int, nargs='+')
+# Seed nodes of each sampled subgraph
+parser.add_argument('--seed-batch-size', type=int, default=1024)
+# Run the model in bfloat16 autocast, with the node features in bfloat16
+parser.add_argument('--precision', choices=['float32', 'bfloat16'],
+                    default='float32')
+args = parser.parse_args()
+
+if args.compile and len(args.lr) > 1:
+    parser.error('--compile only supports a single learning rate, the '
+                 'vectorized training of several is not compiled')
+if args.num_neighbors is not None and args.batching != 'loader':
+    parser.error('--num-neighbors samples new subgraphs in every epoch, '
+                 'so it only supports --batching loader')
+if args.num_neighbors is not None and \
+        len(args.num_neighbors) not in [1, args.num_layers]:
+    parser.error('--num-neighbors needs one value or one per layer')
+
+dataset_name = args.dataset_name
+layer_name = args.layer_name
+lrs = args.lr
+num_layers = args.num_layers
+hidden_dim = args.hidden_dim
+batch_size = args.batch_size
+batching = args.batching
+eval_every = args.eval_every
+fused_train_loss = args.fused_train_loss
+precision = args.precision
 
 ## 0. Set torch configurations ################################################
 
@@ -32,17 +72,38 @@ print('Device: {}'.format(device))
 dataset_root = f'data/datasets/synthetic/{dataset_name}_0.2-0.2_'
 
 # Datasets
-train_dataset = [data.to(device) for data in
-                 torch.load(f'{dataset_root}train.pt')]
-val_dataset = [data.to(device) for data in torch.load(f'{dataset_root}val.pt')]
-test_dataset = [data.to(device) for data in
-                torch.load(f'{dataset_root}test.pt')]
+features_dtype = feature_dtypes[precision]
+train_dataset = load_dataset(f'{dataset_root}train', device,
+                             features_dtype=features_dtype)
+val_dataset = load_dataset(f'{dataset_root}val', device,
+                           features_dtype=features_dtype)
+test_dataset = load_dataset(f'{dataset_root}test', device,
+                            features_dtype=features_dtype)
 
 # Data loaders
-train_data_loader = DataLoader(train_dataset, batch_size=batch_size,
-                               shuffle=True)
-val_data_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=True)
-test_data_loader = DataLoader(test_dataset, batch_size=1, shuffle=False)
+if args.num_neighbors is None:
+    train_data_loader = DataLoader(train_dataset, batch_size=batch_size,
+                                   shuffle=True)
+    val_data_loader = DataLoader(val_dataset, batch_size=batch_size,
+                                 shuffle=True)
+    test_data_loader = DataLoader(test_dataset, batch_size=1, shuffle=False)
+else:
+    # The MLP only needs the seed nodes
+    if layer_name == 'mlp':
+        num_neighbors = []
+    elif len(args.num_neighbors) == 1:
+        num_neighbors = args.num_neighbors * num_layers
+    else:
+        num_neighbors = args.num_neighbors
+
+    train_data_loader = NeighborSampledLoader(
+        train_dataset, num_neighbors, batch_size=args.seed_batch_size,
+        shuffle=True)
+    val_data_loader = NeighborSampledLoader(
+        val_dataset, num_neighbors, batch_size=args.seed_batch_size,
+        shuffle=True)
+    test_data_loader = NeighborSampledLoader(
+        test_dataset, num_neighbors, batch_size=args.seed_batch_size)
 
 ## 2. Create the model ########################################################
 
@@ -58,13 +119,17 @@ model = layers[layer_name](input_dim=train_dataset[0].num_features,
 
 # Paths variables
 scenario = dataset_name.split('_')[-1]
-config = f'{layer_name}_{scenario}_{lr}_{num_layers}_{hidden_dim}_b{batch_size}'
-training_results_path = f'data/tuning_results/{dataset_name}/{layer_name}/{config}.png'
-best_model_path = f'models/tuning/{dataset_name}/{layer_name}/{config}.pt'
+configs = [f'{layer_name}_{scenario}_{lr}_{num_layers}_{hidden_dim}_b{batch_size}'
+           for lr in lrs]
+training_results_paths = [f'data/tuning_results/{dataset_name}/{layer_name}/{config}.png'
+                          for config in configs]
+best_model_paths = [f'models/tuning/{dataset_name}/{layer_name}/{config}.pt'
+                    for config in configs]
 
 # Training parameters
 epochs = 10000
-early_stopping_steps = 1000
+# Patience in evaluation rounds, the same number of epochs for any eval_every
+early_stopping_steps = 1000 // eval_every
 criterion = torch.nn.MSELoss()
 optimizer = torch.optim.Adam
 
@@ -73,19 +138,44 @@ torch.manual_seed(0)
 model.reset_parameters()
 
 # Save the model
-best_model = train_model(original_model=model,
-                         train_data_loader=train_data_loader,
-                         val_data_loader=val_data_loader, optimizer=optimizer,
-                         loss_fn=criterion, lr=lr, epochs=epochs,
-                         early_stopping_steps=early_stopping_steps,
-                         is_gnn=is_gnn, results_file=training_results_path,
-                         model_file=best_model_path)
+if len(lrs) == 1:
+    # Interrupted runs are resumed from their last checkpoint
+    checkpoint_path = f'models/checkpoints/{dataset_name}/{layer_name}/{configs[0]}.ckpt'
+
+    best_models = [train_model(original_model=model,
+                               train_data_loader=train_data_loader,
+                               val_data_loader=val_data_loader,
+                               optimizer=optimizer, loss_fn=criterion,
+                               lr=lrs[0], epochs=epochs,
+                               early_stopping_steps=early_stopping_steps,
+                               is_gnn=is_gnn,
+                               results_file=training_results_paths[0],
+                               model_file=best_model_paths[0],
+                               batching=batching, eval_every=eval_every,
+                               fused_train_loss=fused_train_loss,
+                               checkpoint_file=checkpoint_path,
+                               compiled=args.compile, precision=precision)]
+else:
+    # The same initial model and batches as separate runs of each lr
+    best_models = train_models(original_models=[model] * len(lrs),
+                               train_data_loader=train_data_loader,
+                               val_data_loader=val_data_loader,
+                               loss_fn=criterion, lrs=lrs, epochs=epochs,
+                               early_stopping_steps=early_stopping_steps,
+                               is_gnn=is_gnn,
+                               results_files=training_results_paths,
+                               model_files=best_model_paths,
+                               batching=batching, eval_every=eval_every,
+                               fused_train_loss=fused_train_loss,
+                               precision=precision)
 
 ## 4. Print the best results ##################################################
 
-print(
-    f'\nTrain loss: {test_torch(best_model, train_data_loader, criterion, is_gnn):.4f}')
-print(
-    f'Validation loss: {test_torch(best_model, val_data_loader, criterion, is_gnn):.4f}')
-print(
-    f'Test loss: {test_torch(best_model, test_data_loader, criterion, is_gnn):.4f}')
+for lr, best_model in zip(lrs, best_models):
+    print(f'\nLearning rate: {lr}')
+    print(
+        f'Train loss: {test_torch(best_model, train_data_loader, criterion, is_gnn, precision):.4f}')
+    print(
+        f'Validation loss: {test_torch(best_model, val_data_loader, criterion, is_gnn, precision):.4f}')
+    print(
+        f'Test loss: {test_torch(best_model, test_data_loader, criterion, is_gnn, precision):.4f}')
@@ -0,0 +1,52 @@
+import itertools
+import os
+
+import pandas as pd
+import torch
+
+from gnn4bcprediction.tuning import successive_halving
+
+## 0. Set torch configurations ################################################
+
+torch.set_default_tensor_type(torch.FloatTensor)
+
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+## 1. Set the hyperparameter grid and the sweep configuration #################
+
+scenarios = ['hom', 'com']
+layer_names = ['mlp', 'gcn', 'sage', 'gatv2']
+lr_list = [0.01, 0.001, 0.0001]
+L_list = [4, 5]
+H_list = [16, 32]
+bs_list = [2, 4, 8]
+
+# Successive halving: a third of the configs of each scenario/layer are kept
+# after 1112 and 3334 epochs, and trained up to 10000 epochs
+max_epochs = 10000
+eta = 3
+num_rungs = 3
+processes = os.cpu_count()
+# 'float32', or 'bfloat16' autocast with the node features in bfloat16
+precision = 'float32'
+results_file = 'data/tuning_results/sweep_results.csv'
+
+## 2. Train the grid ##########################################################
+
+configs = [{'dataset_name': f'synthetic_1000000_10_20_0.5_{scenario}',
+            'layer_name': layer_name, 'lr': lr, 'num_layers': L,
+            'hidden_dim': H, 'batch_size': bs}
+           for scenario, layer_name, lr, L, H, bs in itertools.product(
+               scenarios, layer_names, lr_list, L_list, H_list, bs_list)]
+
+if __name__ == '__main__':
+    results = successive_halving(configs, max_epochs=max_epochs, eta=eta,
+                                 num_rungs=num_rungs, processes=processes,
+                                 device=device, precision=precision)
+
+    ## 3. Save the results ####################################################
+
+    os.makedirs(os.path.dirname(results_file), exist_ok=True)
+    pd.DataFrame(results).sort_values(by='mse_val').to_csv(results_file,
+                                                           index=False)
+    print(f'Results saved in {results_file}')